@@ -1,18 +1,31 @@
+import logging
+import os
+
 import click
-from sensorthings import build_unit_of_measurement, SensorThingsClient
+import modelspec
+from entitycache import EntityCache
+from getEntities import normalize_id
+from sensorthings import build_unit_of_measurement, build_observed_property, build_sensor, SensorThingsClient
+
+# temperature datastreams of the measuring field in the printer housing
+default_spec = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cm_temperatures.json')
 
 
 @click.command()
 @click.option('--server', default='http://localhost:8080', help='URL of SensorThings server')
 @click.option('--printer_id', help='Id of printer to add ')
-def create_cm_temperatures(server, printer_id):
+@click.option('--cache', is_flag=True, help='Reuse entity ids of earlier runs from the local cache')
+@click.option('--server-lookup', is_flag=True, help='Look entities up one by one instead of loading the catalog')
+def create_cm_temperatures(server, printer_id, cache, server_lookup):
     """Creates model of Ultimaker's temperature sensors on SensorThings API server"""
 
+    # created and reused entities are logged by the client
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     print("Creating SensorThings model of Ultimaker's temperature sensors on {}".format(server))
 
     # create client for SensorThings API
     # noinspection PyUnusedLocal
-    st_client = SensorThingsClient(server)
+    st_client = SensorThingsClient(server, cache=EntityCache() if cache else None, server_lookup=server_lookup or None)
 
     # ********************************************************************************************************
     # Create datastream for sensing temperatures measurements for each sensor
@@ -20,46 +33,32 @@ def create_cm_temperatures(server, printer_id):
 
     # Mapping for Sensors as shown here:
     # https://secure.salzburgresearch.at/wiki/display/IM/CM+der+Temperatur+am+3D-Drucker+-+Messfeld
-    sensors = [["S321", "wall left-back-top"], ["S211", "wall left-front-top"],
-               ["S111", "wall right-back-top"],
-               ["S412", "wall right-front-top"], ["S212", "wall left-back-bottom"],
-               ["S311", "wall left-front-bottom"],
-               ["S411", "wall right-back-bottom"], ["S121", "wall right-front-top"],
-               ["S312", "wall left-middle-middle"],
-               ["S122", "wall right-middle-middle"],
-               ["S512", "print bed-back-left"], ["S511", "print-bed back-middle"],
-               ["S621", "print-bed back-right"],
-               ["S421", "print-bed middle-left"], ["S622", "print-bed middle-right"],
-               ["S422", "print-bed front-left"],
-               ["S612", "print-bed front-middle"], ["S611", "print-bed front-right"],
-               ["S322", "stepper-motor-y-axis"], ["S112", "stepper-motor-x-axis"]]
-
-    # add the prefix "Temp" to the sensor number e.g.: ["S312", "Temp312", "wall left-back-top"]
-    sensors = [[i[0], i[0].replace("S", "Temp"), i[1]] for i in sensors]
+    # the datastreams are named after the sensor number with the prefix "Temp" e.g.: "S312" -> "Temp312",
+    # see cm_temperatures.json which fleet.py uses as well
+    spec = modelspec.load_spec(default_spec)
+    sensors = [[ds["name"].replace("Temp", "S"), ds["name"], ds["description"]] for ds in spec["Datastreams"]]
 
-    sensor_op_ids = dict()
     sensor_ds_ids = dict()
 
-    temperature_sensor_id = st_client.post_sensor(name='LM35',
-                                                  description='Temperature Sensor with Analog Output with 30V Capability',
-                                                  encoding_type='application/pdf',
-                                                  metadata='http://www.ti.com/lit/gpn/LM35').get(
-        '@iot.id')
+    # sensor and observed property are created together with the first datastream (deep insert),
+    # the following datastreams reference them
+    temperature_sensor = build_sensor(name='LM35',
+                                      description='Temperature Sensor with Analog Output with 30V Capability',
+                                      encoding_type='application/pdf',
+                                      metadata='http://www.ti.com/lit/gpn/LM35')
 
     for sensor_id, sensor_code, sensor_desc in sensors:
-        sensor_op_ids[sensor_id] = st_client.post_observed_property(name='Temperature',
-                                                                    description=sensor_desc,
-                                                                    definition='http://www.qudt.org/qudt/owl/1.0.0/quantity/Instances.html#ThermodynamicTemperature').get(
-            '@iot.id')
+        temperature_op = build_observed_property(name='Temperature',
+                                                 description=sensor_desc,
+                                                 definition='http://www.qudt.org/qudt/owl/1.0.0/quantity/Instances.html#ThermodynamicTemperature')
 
         sensor_ds_ids[sensor_id] = st_client.post_datastream(name=sensor_code,
                                                              description=sensor_desc,
                                                              observation_type='http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_Measurement',
                                                              unit_of_measurement=temperature_unit,
-                                                             observed_property={
-                                                                 '@iot.id': sensor_op_ids[sensor_id]},
-                                                             sensor={'@iot.id': temperature_sensor_id},
-                                                             Thing={'@iot.id': printer_id}).get('@iot.id')
+                                                             observed_property=temperature_op,
+                                                             sensor=temperature_sensor,
+                                                             Thing={'@iot.id': normalize_id(printer_id)}).get('@iot.id')
 
 
 # ************************************************************************************************************
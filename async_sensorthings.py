@@ -0,0 +1,293 @@
+import asyncio
+import json
+import time
+from collections import deque, namedtuple
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import requests
+
+import getEntities
+from instrumentation import Instrumentation, RequestEvent
+from observations import build_data_array, build_observation, data_array_order, data_array_statuses, \
+    error_reason, report_rejected, settle, unsupported_status
+from sensorthings import SensorThingsClient, iter_nested, nested_paths, parent_navigation
+
+
+# Reference to another entry of a provisioning plan, replaced by {'@iot.id': <id>} once that entity exists
+Ref = namedtuple('Ref', 'name')
+
+
+# Stands in for the requests session of the shared index, the async client fills the index itself
+# (see load_collection) and must never fall back to blocking requests
+class NoSession:
+    def __init__(self):
+        self.hooks = dict()
+
+    def request(self, method, url, **kwargs):
+        raise RuntimeError('AsyncSensorThingsClient loads collections with load_collection, not with requests')
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+class AsyncSensorThingsClient:
+    """asyncio variant of SensorThingsClient built on aiohttp.
+
+    At most `concurrency` requests are in flight at the same time. Use it as async context manager:
+
+        async with AsyncSensorThingsClient(server) as st_client:
+            ids = await st_client.provision(plan)
+    """
+
+    def __init__(self, base_url, concurrency=10, preload=None, composite_keys=None, instrumentation=None):
+        if aiohttp is None:
+            raise ImportError('AsyncSensorThingsClient requires aiohttp, run pip install aiohttp')
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.preload_paths = preload or []
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.session = None
+        # the index is shared with the synchronous client, collections are filled by load_collection
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        self.model = getEntities.getModel(base_url, composite_keys=composite_keys, session=NoSession(),
+                                          instrumentation=self.instrumentation)
+        self.loading = dict()
+        self.pending = dict()
+        # the newest observations the server rejected as (datastream id, observation, reason),
+        # like ObservationBuffer.rejected
+        self.rejected = deque(maxlen=1000)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency),
+                                                 headers={'Accept': 'application/json'})
+        await asyncio.gather(*(self.load_collection(path) for path in self.preload_paths))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    # the entity builders are shared with SensorThingsClient, they return the coroutine of _post
+    post_thing = SensorThingsClient.post_thing
+    post_datastream = SensorThingsClient.post_datastream
+    post_observed_property = SensorThingsClient.post_observed_property
+    post_sensor = SensorThingsClient.post_sensor
+    # deep inserts are linked and indexed like in SensorThingsClient, only the requests are awaited
+    _is_bound = SensorThingsClient._is_bound
+    _count_nested = SensorThingsClient._count_nested
+    _nested_expand = SensorThingsClient._nested_expand
+    _index_nested = SensorThingsClient._index_nested
+
+    async def _request(self, method, url, **kwargs):
+        status, body = await self._send(method, url, raise_for_status=True, **kwargs)
+        return body
+
+    # Send a request, returns the status and the decoded body (the text for bodies that aren't JSON)
+    async def _send(self, method, url, raise_for_status=False, **kwargs):
+        async with self.semaphore:
+            started = time.perf_counter()
+            async with self.session.request(method, url, **kwargs) as r:
+                body = await r.read()
+                self.instrumentation.request(RequestEvent(method, r.url.path, r.status,
+                                                          len(json.dumps(kwargs['json'])) if 'json' in kwargs else 0,
+                                                          len(body), time.perf_counter() - started, 0))
+                if raise_for_status:
+                    r.raise_for_status()
+                try:
+                    return r.status, json.loads(body) if body else None
+                except ValueError:
+                    return r.status, body.decode('utf-8', 'replace')
+
+    # Stream all entities of a collection, following @iot.nextLink like getEntities.iter_entities
+    async def iter_entities(self, path, params=None, page_size=getEntities.default_page_size):
+        params = dict(params) if params else dict()
+        params.setdefault('$top', page_size)
+        skip = int(params.get('$skip', 0))
+        url, query = self.base_url + path, params
+        while url:
+            page = await self._request('GET', url, params=query)
+            values = page.get('value', [])
+            for entity in values:
+                yield entity
+            if '@iot.nextLink' in page:
+                url, query = page['@iot.nextLink'], None
+            elif query is not None and values and len(values) >= int(query['$top']):
+                skip += len(values)
+                query = dict(params, **{'$skip': skip})
+            else:
+                url = None
+
+    # Fetch a collection into the index once, concurrent callers wait for the same request
+    async def load_collection(self, path):
+        if path in self.model.model:
+            return
+        if path not in self.loading:
+            self.loading[path] = asyncio.ensure_future(self._load_collection(path))
+        await self.loading[path]
+
+    async def _load_collection(self, path):
+        entities = [entity async for entity in self.iter_entities(path, self.model.collection_params(path))]
+        self.model.set_collection(path, entities)
+
+    async def _post(self, path, data, **kwargs):
+        await asyncio.gather(*(self.load_collection(p) for p in set(nested_collections(path, data))))
+        entity = self.model.has_entity(path, data['name'], data)
+        if entity is not None:
+            self.instrumentation.entity('existing', path, data['name'])
+            # nested entities that belong to the existing entity, e.g. new datastreams of a thing, are added to it
+            await asyncio.gather(*(self._post(child_path, dict(child, **{parent_navigation[path]:
+                                                                         {'@iot.id': entity['@iot.id']}}))
+                                   for nav, child_path, child in iter_nested(data)
+                                   if self._is_bound(path, child_path)))
+            return entity
+        # an entity with the same key that is being created right now is awaited instead of posted twice
+        key = (path, self.model.entity_key(path, data['name'], data))
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(self._create(path, data, **kwargs))
+        try:
+            return await self.pending[key]
+        finally:
+            self.pending.pop(key, None)
+
+    async def _create(self, path, data, **kwargs):
+        data = await self._link_nested(path, data, self._count_nested(path, data))
+        entity = await self._request('POST', self.base_url + path, json=data, **kwargs)
+        self.instrumentation.entity('created', path, data['name'])
+        if any(iter_nested(data)):
+            entity = await self._read_nested(path, entity, data)
+        return self.model.add_entity(path, entity, data)
+
+    # Replace nested entities that already exist by references, see SensorThingsClient._link_nested
+    async def _link_nested(self, path, data, counts):
+        linked = dict(data)
+        for nav in nested_paths:
+            values = data.get(nav)
+            if isinstance(values, list):
+                linked[nav] = list(await asyncio.gather(*(self._link_child(path, nested_paths[nav], value, counts)
+                                                          for value in values)))
+            elif values is not None:
+                linked[nav] = await self._link_child(path, nested_paths[nav], values, counts)
+        return linked
+
+    async def _link_child(self, path, child_path, child, counts):
+        if not isinstance(child, dict) or '@iot.id' in child or 'name' not in child:
+            return child
+        if not self._is_bound(path, child_path):
+            existing = self.model.has_entity(child_path, child['name'], child)
+            key = (child_path, self.model.entity_key(child_path, child['name'], child))
+            if existing is None and counts.get(key, 0) > 1:
+                existing = await self._post(child_path, child)
+            if existing is not None:
+                return {'@iot.id': existing['@iot.id']}
+        return await self._link_nested(child_path, child, counts)
+
+    # Read the ids of all entities created by a deep insert back and add them to the index
+    async def _read_nested(self, path, entity, data):
+        created = await self._request('GET', self.base_url + getEntities.entity_path(path, entity['@iot.id']),
+                                      params={'$select': getEntities.select_fields,
+                                              '$expand': self._nested_expand(data)})
+        entity = dict(entity, **created)
+        self._index_nested(path, entity, data)
+        return entity
+
+    # Send readings of a datastream right away, each a dict or a (phenomenon_time, result) tuple.
+    # Returns the number of readings the server accepted, readings it rejected for good (4xx) are logged
+    # and kept in rejected. Transient failures (connection errors, 5xx) are raised, see settle.
+    async def post_observations(self, datastream_id, observations):
+        buffer = {datastream_id: [o if isinstance(o, dict) else build_observation(o[1], o[0]) for o in observations]}
+        count = len(buffer[datastream_id])
+        rejected = list()
+        try:
+            status, body = await self._send('POST', self.base_url + '/v1.0/CreateObservations',
+                                            json=build_data_array(buffer))
+            if status < 400:
+                settle(buffer, data_array_order(buffer), data_array_statuses(body), rejected)
+            elif status >= 500 and status not in unsupported_status:
+                raise requests.HTTPError('CreateObservations failed: {}'.format(error_reason(status, body)))
+            else:
+                # no CreateObservations (404, 405, 501) or a bad reading (400), single POSTs tell which
+                await self._post_each(buffer, rejected)
+        finally:
+            self.rejected.extend(rejected)
+            report_rejected(self.instrumentation, rejected)
+        return count - len(rejected)
+
+    async def _post_each(self, buffer, rejected):
+        for datastream_id, readings in buffer.items():
+            url = self.base_url + getEntities.entity_path('/v1.0/Datastreams', datastream_id) + '/Observations'
+            answers = await asyncio.gather(*(self._send('POST', url, json=o) for o in readings))
+            failed = [(status, body) for status, body in answers if status >= 500]
+            rejected.extend((datastream_id, o, error_reason(status, body))
+                            for o, (status, body) in zip(readings, answers) if 400 <= status < 500)
+            if failed:
+                raise requests.HTTPError('{} of {} observations failed with a server error: {}'.format(
+                    len(failed), len(readings), error_reason(*failed[0])))
+
+    # Create all entities of a plan, a dict of key -> (post method name, keyword arguments).
+    # Arguments given as Ref(key) depend on other entries and are resolved to their @iot.id, all
+    # other entries are created concurrently, so wall time is bounded by the depth of the plan.
+    # Returns a dict of key -> @iot.id.
+    async def provision(self, plan):
+        check_plan(plan)
+        tasks = dict()
+
+        def schedule(key):
+            if key not in tasks:
+                tasks[key] = asyncio.ensure_future(create(key))
+            return tasks[key]
+
+        async def create(key):
+            method, kwargs = plan[key]
+            refs = [(arg, value.name) for arg, value in kwargs.items() if isinstance(value, Ref)]
+            parents = await asyncio.gather(*(schedule(name) for arg, name in refs))
+            kwargs = dict(kwargs)
+            for (arg, name), parent in zip(refs, parents):
+                kwargs[arg] = {'@iot.id': parent.get('@iot.id')}
+            return await getattr(self, method)(**kwargs)
+
+        results = await asyncio.gather(*(schedule(key) for key in plan))
+        return {key: entity.get('@iot.id') for key, entity in zip(plan, results)}
+
+
+# Yield the collections of an entity and all entities nested in it, they have to be in the index before it is posted
+def nested_collections(path, data):
+    yield path
+    for nav, child_path, child in iter_nested(data):
+        for nested_path in nested_collections(child_path, child):
+            yield nested_path
+
+
+# Make sure every Ref of a plan points to an existing entry and there are no cycles
+def check_plan(plan):
+    state = dict()
+
+    def visit(key, trail):
+        if key not in plan:
+            raise ValueError('Unknown reference {!r} in plan, referenced by {!r}'.format(key, trail[-1]))
+        if state.get(key) == 'done':
+            return
+        if state.get(key) == 'visiting':
+            raise ValueError('Cyclic references in plan: {}'.format(' -> '.join(trail + [key])))
+        state[key] = 'visiting'
+        for value in plan[key][1].values():
+            if isinstance(value, Ref):
+                visit(value.name, trail + [key])
+        state[key] = 'done'
+
+    for key in plan:
+        visit(key, [])
@@ -0,0 +1,178 @@
+import contextlib
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import time
+import traceback
+
+import click
+
+import modelspec
+from fakeserver import FakeSensorThingsServer
+from sensorthings import SensorThingsClient, build_observed_property, build_sensor, build_unit_of_measurement
+
+# the benchmark may be started from any directory
+ultimaker_spec = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ultimaker.json')
+
+temperature_unit = build_unit_of_measurement(name='Degree Celsius', symbol='degC',
+                                             definition='http://www.qudt.org/qudt/owl/1.0.0/unit/Instances.html#DegreeCelsius')
+
+
+# ************************************************************************************************************
+# Scenarios, setup runs in the benchmark process and seeds the server, run in a separate process
+# so its peak RSS is the one of the client only
+# ************************************************************************************************************
+def setup_ultimaker(server, options):
+    pass
+
+
+def run_ultimaker(url, options):
+    # a cold run creating the model followed by a run against the provisioned server
+    for i in range(2):
+        st_client = SensorThingsClient(url)
+        modelspec.apply(st_client, modelspec.plan(st_client, modelspec.load_spec(ultimaker_spec)))
+
+
+def setup_cm_temperatures(server, options):
+    server.seed('Things', [{'name': 'Ultimaker 2', 'description': '3D printer'}])
+
+
+def run_cm_temperatures(url, options):
+    st_client = SensorThingsClient(url)
+    printer_id = st_client.model.has_entity('/v1.0/Things', 'Ultimaker 2')['@iot.id']
+    sensor = build_sensor(name='LM35', description='Temperature Sensor', encoding_type='application/pdf',
+                          metadata='http://www.ti.com/lit/gpn/LM35')
+    for i in range(20 * options['scale']):
+        op = build_observed_property(name='Temperature', description='sensor {}'.format(i),
+                                     definition='http://www.qudt.org/qudt/owl/1.0.0/quantity/Instances.html#ThermodynamicTemperature')
+        st_client.post_datastream(name='Temp{}'.format(i), description='sensor {}'.format(i),
+                                  observation_type='http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_Measurement',
+                                  unit_of_measurement=temperature_unit, observed_property=op, sensor=sensor,
+                                  Thing={'@iot.id': printer_id})
+
+
+def setup_catalog(server, options):
+    server.seed('Sensors', ({'name': 'Sensor {}'.format(i), 'description': 'benchmark sensor',
+                             'encodingType': 'application/pdf', 'metadata': 'none'}
+                            for i in range(options['catalog_size'])))
+
+
+def run_catalog(url, options):
+    st_client = SensorThingsClient(url, preload=['/v1.0/Sensors'])
+    assert st_client.model.has_entity('/v1.0/Sensors', 'Sensor {}'.format(options['catalog_size'] - 1))
+
+
+def setup_ingest(server, options):
+    server.seed('Things', [{'name': 'Ultimaker 2', 'description': '3D printer'}])
+    server.seed('Datastreams', [{'name': 'Temp{}'.format(i), 'description': 'benchmark datastream',
+                                 'Thing': {'@iot.id': 1}} for i in range(20)])
+
+
+def run_ingest(url, options):
+    st_client = SensorThingsClient(url, batch_size=options['batch_size'])
+    datastream_ids = [entity['@iot.id'] for entity in st_client.model.get_collection('/v1.0/Datastreams')]
+    for i in range(options['observations']):
+        st_client.post_observation(datastream_ids[i % len(datastream_ids)], float(i))
+    st_client.close()
+
+
+scenarios = {'ultimaker': (setup_ultimaker, run_ultimaker),
+             'cm_temperatures': (setup_cm_temperatures, run_cm_temperatures),
+             'catalog': (setup_catalog, run_catalog),
+             'ingest': (setup_ingest, run_ingest)}
+
+
+# Run a scenario in the child process, puts ('ok', (wall, peak rss)) or ('error', traceback) on results
+def _child(run, url, options, results):
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            run(url, options)
+            wall = time.perf_counter() - started
+        results.put(('ok', (wall, peak_rss())))
+    except BaseException:
+        results.put(('error', traceback.format_exc()))
+
+
+# Peak resident set size of this process in bytes
+def peak_rss():
+    # ru_maxrss survives exec and would include the benchmark process the child was forked from,
+    # VmHWM is reset by exec
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return rss * 1024 if sys.platform != 'darwin' else rss
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+# Run a scenario against a fresh fake server and return its measurements
+def run_scenario(name, options):
+    setup, run = scenarios[name]
+    # spawn instead of fork, a forked child would count the pages of the benchmark process in its RSS
+    context = multiprocessing.get_context('spawn')
+    with FakeSensorThingsServer(latency=options['latency'], max_page_size=options['page_size']) as server:
+        setup(server, options)
+        results = context.Queue()
+        process = context.Process(target=_child, args=(run, server.url, options, results))
+        process.start()
+        while True:
+            try:
+                status, result = results.get(timeout=1.0)
+                break
+            except queue.Empty:
+                # the child died without reporting, e.g. killed by the OOM killer
+                if not process.is_alive():
+                    raise RuntimeError('Scenario {} exited with code {}'.format(name, process.exitcode))
+        process.join()
+        if status == 'error':
+            raise RuntimeError('Scenario {} failed:\n{}'.format(name, result))
+        wall, rss = result
+        latencies = [request[3] for request in server.requests]
+        return {'scenario': name, 'requests': len(latencies), 'wall_s': wall,
+                'p50_ms': percentile(latencies, 0.5) * 1000, 'p99_ms': percentile(latencies, 0.99) * 1000,
+                'peak_rss_mb': rss / 2 ** 20}
+
+
+@click.command()
+@click.option('--scenario', '-s', 'names', multiple=True, type=click.Choice(sorted(scenarios)),
+              help='Scenario to run, can be given several times (default: all)')
+@click.option('--latency', default=0.0, help='Latency in seconds added to every request of the fake server')
+@click.option('--page-size', default=100, help='Maximum page size of the fake server')
+@click.option('--scale', default=100, help='Multiple of the 20 CM temperature sensors to create')
+@click.option('--catalog-size', default=100000, help='Number of sensors in the catalog scenario')
+@click.option('--observations', default=100000, help='Number of observations in the ingest scenario')
+@click.option('--batch-size', default=500, help='Observation batch size in the ingest scenario')
+@click.option('--json', 'json_file', help='Write the results to this file as JSON')
+def benchmark(names, latency, page_size, scale, catalog_size, observations, batch_size, json_file):
+    """Runs client scenarios against a local fake SensorThings server"""
+
+    options = {'latency': latency, 'page_size': page_size, 'scale': scale, 'catalog_size': catalog_size,
+               'observations': observations, 'batch_size': batch_size}
+    results = list()
+    print('{:<16} {:>9} {:>9} {:>9} {:>9} {:>12}'.format('scenario', 'requests', 'wall s', 'p50 ms', 'p99 ms',
+                                                         'peak RSS MB'))
+    for name in names or sorted(scenarios):
+        result = run_scenario(name, options)
+        results.append(result)
+        print('{scenario:<16} {requests:>9} {wall_s:>9.2f} {p50_ms:>9.2f} {p99_ms:>9.2f} {peak_rss_mb:>12.1f}'
+              .format(**result))
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump({'options': options, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,266 @@
+import atexit
+import copy
+import threading
+from datetime import datetime, timezone
+from time import monotonic
+
+from getEntities import entity_path
+from observations import build_observation
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value.split('/', 1)[0].replace('Z', '+00:00'))
+
+
+def format_time(value):
+    return value.astimezone(timezone.utc).isoformat()
+
+
+# Add how a stored value was derived to the parameters of an observation
+def with_parameters(observation, **parameters):
+    observation = dict(observation)
+    observation['parameters'] = dict(observation.get('parameters') or dict(), **parameters)
+    return observation
+
+
+# Only pass readings that differ at least threshold from the last passed one (threshold=0 passes changes only).
+# The number of suppressed readings is recorded in the parameters of the next passed one.
+class Deadband:
+    def __init__(self, threshold=0):
+        self.threshold = threshold
+        self.last = None
+        self.suppressed = 0
+
+    def process(self, observation):
+        value = observation.get('result')
+        if self.last is not None:
+            try:
+                unchanged = abs(value - self.last) <= self.threshold if self.threshold else value == self.last
+            except TypeError:
+                unchanged = value == self.last
+            if unchanged:
+                self.suppressed += 1
+                return []
+        self.last = value
+        passed = with_parameters(observation, deadband=self.threshold, suppressed=self.suppressed)
+        self.suppressed = 0
+        return [passed]
+
+    def expire(self, now):
+        return []
+
+    def flush(self):
+        return []
+
+
+# Replace the readings of fixed windows of `seconds` by one observation with their mean as result,
+# min, max and count in the parameters and the window as phenomenonTime interval.
+# Parameters of earlier stages are kept, counts like the readings suppressed by a Deadband are summed up.
+class WindowAggregate:
+    # parameters of the readings that are summed up, the other ones keep the value of the last reading
+    summed = ('suppressed', 'dropped')
+    # an ended window is kept until no reading arrived for idle seconds, readings from the past may still come
+    idle = 1.0
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.window = None
+        self.values = list()
+        self.parameters = dict()
+        self.updated = None
+
+    def process(self, observation):
+        time = parse_time(observation['phenomenonTime'])
+        window = int(time.timestamp() // self.seconds)
+        emitted = self.flush() if self.window is not None and window != self.window else []
+        self.window = window
+        self.updated = monotonic()
+        for key, value in (observation.get('parameters') or dict()).items():
+            self.parameters[key] = self.parameters.get(key, 0) + value if key in self.summed else value
+        if isinstance(observation.get('result'), (int, float)):
+            self.values.append(observation['result'])
+        return emitted
+
+    # Send the window if it ended before now, for datastreams that went quiet
+    def expire(self, now):
+        if self.window is None or now.timestamp() < (self.window + 1) * self.seconds \
+                or monotonic() - self.updated < self.idle:
+            return []
+        return self.flush()
+
+    def flush(self):
+        parameters, self.parameters = self.parameters, dict()
+        if self.window is None or not self.values:
+            self.window = None
+            return []
+        start = datetime.fromtimestamp(self.window * self.seconds, timezone.utc)
+        end = datetime.fromtimestamp((self.window + 1) * self.seconds, timezone.utc)
+        observation = {'phenomenonTime': '{}/{}'.format(format_time(start), format_time(end)),
+                       'resultTime': format_time(end),
+                       'result': sum(self.values) / len(self.values)}
+        observation = with_parameters(observation, **parameters)
+        observation = with_parameters(observation, aggregation='mean', window=self.seconds, count=len(self.values),
+                                      min=min(self.values), max=max(self.values))
+        self.window = None
+        self.values = list()
+        return [observation]
+
+
+# Pass at most one reading per min_interval seconds, the number of dropped readings is recorded
+class RateLimit:
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self.last = None
+        self.dropped = 0
+
+    def process(self, observation):
+        time = parse_time(observation['phenomenonTime'])
+        if self.last is not None and (time - self.last).total_seconds() < self.min_interval:
+            self.dropped += 1
+            return []
+        self.last = time
+        passed = with_parameters(observation, rateLimit=self.min_interval, dropped=self.dropped)
+        self.dropped = 0
+        return [passed]
+
+    def expire(self, now):
+        return []
+
+    def flush(self):
+        return []
+
+
+# Chain of stages for one datastream, every observation passed by a stage is handed to the next one
+class Pipeline:
+    def __init__(self, stages):
+        self.stages = list(stages)
+
+    def process(self, observation, start=0):
+        observations = [observation]
+        for stage in self.stages[start:]:
+            observations = [passed for o in observations for passed in stage.process(o)]
+        return observations
+
+    # Send what the stages hold back, e.g. partial windows
+    def flush(self):
+        return self._drain(lambda stage: stage.flush())
+
+    # Send what the stages hold back although it is complete at time now, e.g. ended windows
+    def expire(self, now):
+        return self._drain(lambda stage: stage.expire(now))
+
+    def _drain(self, release):
+        flushed = list()
+        for i, stage in enumerate(self.stages):
+            for observation in release(stage):
+                flushed.extend(self.process(observation, i + 1))
+        return flushed
+
+
+# Observation write path stage that downsamples readings before they reach the buffer or spool.
+# config maps datastream names (or ids) to lists of stages, e.g.
+#   {'Filament Movement DS': [Deadband()], 'Filament Usage DS': [WindowAggregate(10)]}
+# Every datastream gets its own copy of the stages, readings of other datastreams are passed unchanged.
+# A window is sent with the first reading of the next window or, if its datastream went quiet, by a
+# background thread checking every `interval` seconds. Partial windows are sent on flush and at exit.
+class DownsamplingBuffer:
+    def __init__(self, inner, config, model=None, interval=1.0):
+        self.inner = inner
+        self.config = config
+        self.model = model
+        self.interval = interval
+        self.pipelines = dict()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        # datastream id -> name, see datastream_name
+        self.names = dict()
+
+    def __len__(self):
+        return len(self.inner)
+
+    # stats, depth etc. of the wrapped buffer or spool
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def pipeline(self, datastream_id):
+        if datastream_id not in self.pipelines:
+            stages = self.config.get(datastream_id)
+            if stages is None and self.model is not None:
+                stages = self.config.get(self.datastream_name(datastream_id))
+            self.pipelines[datastream_id] = Pipeline(copy.deepcopy(stages)) if stages else None
+        return self.pipelines[datastream_id]
+
+    # Name of a datastream configured by name, taken from the index if the datastreams are loaded anyway,
+    # otherwise only this datastream is fetched. Answers are cached, None for unknown datastreams.
+    def datastream_name(self, datastream_id):
+        if datastream_id not in self.names:
+            index = self.model.model.get('/v1.0/Datastreams')
+            if index is not None:
+                names = [e.get('name') for e in index.values() if str(e['@iot.id']) == str(datastream_id)]
+                self.names[datastream_id] = names[0] if names else None
+            else:
+                r = self.model.session.get(self.model.base_url + entity_path('/v1.0/Datastreams', datastream_id),
+                                           params={'$select': 'name'})
+                if r.status_code != 404:
+                    r.raise_for_status()
+                self.names[datastream_id] = r.json().get('name') if r.status_code != 404 else None
+        return self.names[datastream_id]
+
+    def add(self, datastream_id, result, phenomenon_time=None, **kwargs):
+        self.add_many(datastream_id, [build_observation(result, phenomenon_time, **kwargs)])
+
+    def add_many(self, datastream_id, observations):
+        self.start()
+        with self.lock:
+            pipeline = self.pipeline(datastream_id)
+            passed = list()
+            if pipeline is not None:
+                for observation in observations:
+                    if not isinstance(observation, dict):
+                        observation = build_observation(observation[1], observation[0])
+                    passed.extend(pipeline.process(observation))
+        if pipeline is None:
+            self.inner.add_many(datastream_id, observations)
+        elif passed:
+            self.inner.add_many(datastream_id, passed)
+
+    # Hand what the pipelines hold back to the inner buffer, only ended windows if now is given
+    def _flush_pipelines(self, now=None):
+        with self.lock:
+            flushed = [(datastream_id, pipeline.flush() if now is None else pipeline.expire(now))
+                       for datastream_id, pipeline in self.pipelines.items() if pipeline is not None]
+        for datastream_id, observations in flushed:
+            if observations:
+                self.inner.add_many(datastream_id, observations)
+
+    def flush(self):
+        self._flush_pipelines()
+        return self.inner.flush()
+
+    # Start the thread sending the windows of quiet datastreams, done on the first add.
+    # Partial windows are sent at exit.
+    def start(self):
+        if self.thread is None:
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run, name='downsampling-flusher', daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    def close(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+            atexit.unregister(self.close)
+        self._flush_pipelines()
+        self.inner.close()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self._flush_pipelines(datetime.now(timezone.utc))
+            except Exception as e:
+                # the inner buffer keeps the readings it failed to send and retries them
+                self.inner.last_error = repr(e)
+                self.instrumentation.count('observation_send_failures')
@@ -0,0 +1,110 @@
+import json
+from collections.abc import Mapping
+
+
+# Entity of the model cache. @iot.id and name are kept in slots, all other fields of the server's answer
+# as compact JSON text that is only decoded when one of them is read, so an indexed entity costs a few
+# dozen bytes instead of a dict per entity and nested entity.
+# Entities are read-only mappings, entity['@iot.id'], entity.get('name') and dict(entity) work as before.
+class Entity(Mapping):
+    __slots__ = ("id", "name", "_extra")
+    # collection of the entity type, see entity_classes
+    path = None
+
+    def __init__(self, entity_id, name=None, extra=None):
+        self.id = entity_id
+        self.name = name
+        self._extra = json.dumps(extra, separators=(",", ":")) if extra else None
+
+    # Build an entity from the decoded JSON of the server, keeping only the projected fields in slots
+    @classmethod
+    def from_json(cls, values):
+        extra = dict(values)
+        entity_id = extra.pop("@iot.id", None)
+        name = extra.pop("name", None)
+        return cls(entity_id, name, extra)
+
+    # Fields besides @iot.id and name, decoded on every access and not kept
+    @property
+    def extra(self):
+        return json.loads(self._extra) if self._extra else dict()
+
+    def __getitem__(self, key):
+        if key == "@iot.id":
+            return self.id
+        if key == "name" and self.name is not None:
+            return self.name
+        if self._extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __iter__(self):
+        yield "@iot.id"
+        if self.name is not None:
+            yield "name"
+        if self._extra is not None:
+            for key in self.extra:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "{}(id={!r}, name={!r})".format(type(self).__name__, self.id, self.name)
+
+
+class Thing(Entity):
+    __slots__ = ()
+    path = "/v1.0/Things"
+
+
+class Sensor(Entity):
+    __slots__ = ()
+    path = "/v1.0/Sensors"
+
+
+class ObservedProperty(Entity):
+    __slots__ = ()
+    path = "/v1.0/ObservedProperties"
+
+
+# The id of the Thing a datastream belongs to is part of its index key and kept in a slot as well
+class Datastream(Entity):
+    __slots__ = ("thing_id",)
+    path = "/v1.0/Datastreams"
+
+    def __init__(self, entity_id, name=None, extra=None, thing_id=None):
+        Entity.__init__(self, entity_id, name, extra)
+        self.thing_id = thing_id
+
+    @classmethod
+    def from_json(cls, values):
+        thing = values.get("Thing")
+        # only a bare reference is projected, an expanded Thing with more fields stays in the extra fields
+        if not (isinstance(thing, dict) and list(thing) == ["@iot.id"]):
+            return super().from_json(values)
+        entity = super().from_json({key: value for key, value in values.items() if key != "Thing"})
+        entity.thing_id = thing["@iot.id"]
+        return entity
+
+    def __getitem__(self, key):
+        if key == "Thing" and self.thing_id is not None:
+            return {"@iot.id": self.thing_id}
+        return Entity.__getitem__(self, key)
+
+    def __iter__(self):
+        for key in Entity.__iter__(self):
+            yield key
+        if self.thing_id is not None:
+            yield "Thing"
+
+
+# entity class per collection, other collections use Entity
+entity_classes = {cls.path: cls for cls in (Thing, Sensor, ObservedProperty, Datastream)}
+
+
+# Convert an entity decoded from JSON to the entity class of its collection, entities are returned as they are
+def from_json(path, values):
+    if isinstance(values, Entity):
+        return values
+    return entity_classes.get(path, Entity).from_json(values)
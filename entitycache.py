@@ -0,0 +1,108 @@
+import atexit
+import json
+import os
+import time
+
+from getEntities import iter_entities
+
+
+def default_cache_file():
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "sensorthings", "entities.json")
+
+
+# Persistent cache of name -> @iot.id per server and collection, so runs don't have to crawl the catalog.
+# Cached collections younger than ttl seconds are used as they are. Older ones with numeric ids are
+# validated by fetching the entities with ids above the cached maximum and a $count request: if the cached
+# plus the new entities add up to the count they are kept, otherwise (deletes, non-numeric ids) the
+# collection is reloaded.
+# Pass an instance as cache to getModel or SensorThingsClient.
+class EntityCache:
+    def __init__(self, filename=None, ttl=3600, validate=True):
+        self.filename = filename if filename else default_cache_file()
+        self.ttl = ttl
+        self.validate = validate
+        self.dirty = False
+        self.data = dict()
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename) as f:
+                    self.data = json.load(f)
+            except ValueError:
+                # a corrupt cache is rebuilt from the server
+                self.data = dict()
+        atexit.register(self.save)
+
+    # Return the entities of a collection of model's server, from the cache if it is still valid
+    def load(self, model, path):
+        entry = self.data.get(model.base_url, dict()).get(path)
+        now = time.time()
+        if entry is not None:
+            if now - entry["fetched"] < self.ttl:
+                return entry["entities"]
+            if self.validate and self._revalidate(model, path, entry):
+                entry["fetched"] = now
+                self.dirty = True
+                return entry["entities"]
+        entities = [compact(model, path, entity) for entity in
+                    iter_entities(model.base_url, path, model.collection_params(path), prefetch=True,
+                                  session=model.session)]
+        self.data.setdefault(model.base_url, dict())[path] = {"fetched": now, "entities": entities}
+        self.dirty = True
+        return entities
+
+    def _revalidate(self, model, path, entry):
+        cached = entry["entities"]
+        ids = [entity["@iot.id"] for entity in cached]
+        if not all(isinstance(i, int) for i in ids):
+            return False
+        r = model.session.get(model.base_url + path, params={"$count": "true", "$top": 0})
+        if not r.ok:
+            return False
+        count = r.json().get("@iot.count")
+        # the delta is fetched even if the count did not change, a delete plus a create keep the count
+        params = dict(model.collection_params(path), **{"$filter": "id gt {}".format(max(ids) if ids else -1)})
+        delta = [compact(model, path, entity) for entity in
+                 iter_entities(model.base_url, path, params, session=model.session)]
+        if count is None or len(cached) + len(delta) != count:
+            # entities were deleted, reload the collection
+            return False
+        cached.extend(delta)
+        return True
+
+    # Add an entity created by model to the cache, data holds the posted entity
+    def add(self, model, path, entity, data=None):
+        entry = self.data.get(model.base_url, dict()).get(path)
+        if entry is not None:
+            entry["entities"].append(compact(model, path, dict(data or dict(), **entity)))
+            self.dirty = True
+
+    # Drop the cached collections of a server, or all of them
+    def clear(self, base_url=None):
+        if base_url is None:
+            self.data = dict()
+        else:
+            self.data.pop(base_url, None)
+        self.dirty = True
+
+    # Write the cache to disk, called automatically at exit
+    def save(self):
+        if not self.dirty:
+            return
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.data, f, separators=(",", ":"))
+        os.replace(tmp, self.filename)
+        self.dirty = False
+
+
+# Keep only the fields needed to rebuild the index key of an entity
+def compact(model, path, entity):
+    kept = {"@iot.id": entity["@iot.id"], "name": entity.get("name")}
+    for parent in model.composite_keys.get(path, []):
+        if isinstance(entity.get(parent), dict):
+            kept[parent] = {"@iot.id": entity[parent].get("@iot.id")}
+    return kept
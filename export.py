@@ -0,0 +1,102 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from getEntities import entity_path, iter_pages
+
+# initial size of the arrays of a datastream if the server does not tell the number of observations
+default_capacity = 1024
+
+
+# Format a datetime or ISO 8601 string for a $filter expression, naive datetimes are taken as UTC
+def odata_time(value):
+    if isinstance(value, str):
+        return value
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+# Convert ISO 8601 phenomenon times to a datetime64[us] array in UTC, intervals are represented by their start
+def parse_times(values):
+    values = [value.split('/', 1)[0] for value in values]
+    if all(value.endswith('Z') for value in values):
+        return np.array([value[:-1] for value in values], dtype='datetime64[us]')
+    return np.array([datetime.fromisoformat(value.replace('Z', '+00:00')).astimezone(timezone.utc)
+                     .replace(tzinfo=None) for value in values], dtype='datetime64[us]')
+
+
+# Read phenomenonTime and result of the observations of one datastream in [start, end) into two
+# preallocated arrays. Pages are requested with $resultFormat=dataArray, so every page is decoded
+# into lists instead of one dict per observation.
+def read_datastream(client, datastream_id, start=None, end=None, page_size=1000):
+    path = entity_path('/v1.0/Datastreams', datastream_id) + '/Observations'
+    conditions = list()
+    if start is not None:
+        conditions.append('phenomenonTime ge {}'.format(odata_time(start)))
+    if end is not None:
+        conditions.append('phenomenonTime lt {}'.format(odata_time(end)))
+    params = {'$select': 'phenomenonTime,result', '$orderby': 'phenomenonTime asc', '$resultFormat': 'dataArray'}
+    if conditions:
+        params['$filter'] = ' and '.join(conditions)
+
+    r = client.session.get(client.base_url + path, params=dict(params, **{'$count': 'true', '$top': 0}))
+    r.raise_for_status()
+    capacity = r.json().get('@iot.count') or default_capacity
+    times = np.empty(capacity, dtype='datetime64[us]')
+    results = np.empty(capacity, dtype='float64')
+    size = 0
+    for values in iter_pages(client.base_url, path, params, page_size=page_size, session=client.session):
+        page_times, page_results = decode_page(values)
+        if size + len(page_times) > len(times):
+            capacity = max(2 * len(times), size + len(page_times))
+            times, results = np.resize(times, capacity), np.resize(results, capacity)
+        times[size:size + len(page_times)] = parse_times(page_times)
+        results[size:size + len(page_times)] = np.array(page_results, dtype='float64')
+        size += len(page_times)
+    return times[:size], results[:size]
+
+
+# Split a page into phenomenon times and results, for dataArray and for plain entity pages
+def decode_page(values):
+    if values and 'dataArray' in values[0]:
+        page_times, page_results = list(), list()
+        for value in values:
+            components = value['components']
+            columns = list(zip(*value['dataArray'])) if value['dataArray'] else [(), ()]
+            page_times.extend(columns[components.index('phenomenonTime')])
+            page_results.extend(columns[components.index('result')])
+        return page_times, page_results
+    return [value['phenomenonTime'] for value in values], [value.get('result') for value in values]
+
+
+# Read the observations of several datastreams concurrently and align them on their phenomenon times.
+# Returns (times, {column: values}) with NaN where a datastream has no observation at a time, a pandas
+# DataFrame for output='pandas' or a pyarrow Table for output='arrow'. columns optionally maps the
+# datastream ids to column names.
+def get_observations(client, datastream_ids, start=None, end=None, output='numpy', columns=None,
+                     page_size=1000, concurrency=4):
+    if np is None:
+        raise ImportError('get_observations requires numpy, run pip install numpy')
+    datastream_ids = list(datastream_ids)
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(datastream_ids)))) as executor:
+        series = list(executor.map(lambda i: read_datastream(client, i, start, end, page_size), datastream_ids))
+
+    times = np.unique(np.concatenate([t for t, r in series])) if series else np.empty(0, 'datetime64[us]')
+    frame = dict()
+    for datastream_id, (t, r) in zip(datastream_ids, series):
+        column = np.full(len(times), np.nan)
+        column[np.searchsorted(times, t)] = r
+        frame[columns.get(datastream_id, datastream_id) if columns else datastream_id] = column
+
+    if output == 'pandas':
+        import pandas
+        return pandas.DataFrame(frame, index=pandas.DatetimeIndex(times, name='phenomenonTime'))
+    if output == 'arrow':
+        import pyarrow
+        return pyarrow.table(dict({'phenomenonTime': times}, **{str(k): v for k, v in frame.items()}))
+    return times, frame
@@ -0,0 +1,355 @@
+import json
+import re
+import socket
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import getEntities
+
+# collection of a navigation property
+nav_collections = {'Thing': 'Things', 'Things': 'Things', 'Location': 'Locations', 'Locations': 'Locations',
+                   'HistoricalLocations': 'HistoricalLocations', 'Sensor': 'Sensors', 'Datastream': 'Datastreams',
+                   'Datastreams': 'Datastreams', 'ObservedProperty': 'ObservedProperties',
+                   'Observations': 'Observations', 'FeatureOfInterest': 'FeaturesOfInterest'}
+# navigation property of an entity of a collection pointing to it from nested entities
+back_references = {'Things': 'Thing', 'Datastreams': 'Datastream', 'Sensors': 'Sensor',
+                   'ObservedProperties': 'ObservedProperty'}
+filter_clause = re.compile(r"\s*(\w+(?:/id)?)\s+(eq|ne|gt|ge|lt|le)\s+('(?:[^']|'')*'|[^\s]+)\s*(?:and\b|$)")
+compare = {'eq': lambda a, b: a == b, 'ne': lambda a, b: a != b, 'gt': lambda a, b: a > b,
+           'ge': lambda a, b: a >= b, 'lt': lambda a, b: a < b, 'le': lambda a, b: a <= b}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value.split('/', 1)[0].replace('Z', '+00:00'))
+
+
+def parse_literal(value):
+    if value.startswith("'"):
+        return value[1:-1].replace("''", "'")
+    try:
+        return json.loads(value)
+    except ValueError:
+        # unquoted OData literals like datetimes (2024-01-01T00:00:00Z), compared by the caller
+        return value
+
+
+# Split a $expand or option list at top level commas or semicolons
+def split_top_level(value, separator):
+    parts, depth, current = list(), 0, ''
+    for char in value:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == separator and depth == 0:
+            parts.append(current)
+            current = ''
+        else:
+            current += char
+    if current:
+        parts.append(current)
+    return parts
+
+
+# Parse "Thing($select=@iot.id),Datastreams($expand=Sensor)" into {nav: {option: value}}
+def parse_expand(value):
+    expand = dict()
+    for part in split_top_level(value or '', ','):
+        if '(' in part:
+            nav, options = part[:part.index('(')], part[part.index('(') + 1:-1]
+            expand[nav] = dict(option.split('=', 1) for option in split_top_level(options, ';'))
+        else:
+            expand[part] = dict()
+    return expand
+
+
+# In-memory SensorThings server covering the collections of getEntities.entities with pagination,
+# $filter (name, <nav>/id, id, phenomenonTime), $select, $expand, $count, $resultFormat=dataArray,
+# deep inserts, PATCH, CreateObservations and JSON $batch. Every request is delayed by `latency` seconds.
+# Used by benchmark.py, start it with start() and point a client at its url.
+class FakeSensorThingsServer:
+    def __init__(self, latency=0.0, max_page_size=100, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.collections = {path.split('/')[-1]: dict() for path in getEntities.entities}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.requests = list()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='fake-sensorthings', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # Number of requests served and the durations of each (including the injected latency)
+    def request_count(self):
+        return len(self.requests)
+
+    def reset_stats(self):
+        self.requests = list()
+
+    # Insert entities directly without HTTP, e.g. to seed a large catalog
+    def seed(self, collection, entities):
+        with self.lock:
+            for entity in entities:
+                self._store(collection, dict(entity))
+
+    def _store(self, collection, entity):
+        entity['@iot.id'] = self.next_id
+        self.next_id += 1
+        self.collections[collection][entity['@iot.id']] = entity
+        return entity
+
+    # Create an entity and all entities nested in it
+    def create(self, collection, data, parent=None):
+        entity = dict()
+        children = list()
+        for field, value in data.items():
+            target = nav_collections.get(field)
+            if target is None:
+                entity[field] = value
+            elif isinstance(value, list):
+                children.extend((target, child) for child in value)
+            elif '@iot.id' in value:
+                # references are stored with the id type of the server like a real one does
+                entity[field] = {'@iot.id': self._get(target, value['@iot.id'])['@iot.id']}
+            else:
+                entity[field] = {'@iot.id': self.create(target, value)['@iot.id']}
+        if parent is not None:
+            entity[parent[0]] = {'@iot.id': parent[1]}
+        if 'name' not in entity and collection not in ('Observations', 'HistoricalLocations'):
+            raise HTTPError(400, 'name is required')
+        with self.lock:
+            entity = self._store(collection, entity)
+        for target, child in children:
+            if '@iot.id' in child:
+                self._get(target, child['@iot.id'])[back_references[collection]] = {'@iot.id': entity['@iot.id']}
+            else:
+                self.create(target, child, (back_references[collection], entity['@iot.id']))
+        return entity
+
+    def _get(self, collection, entity_id):
+        if isinstance(entity_id, str) and entity_id.isdigit():
+            entity_id = int(entity_id)
+        if collection not in self.collections or entity_id not in self.collections[collection]:
+            raise HTTPError(404, 'No such entity {}({})'.format(collection, entity_id))
+        return self.collections[collection][entity_id]
+
+    def _related(self, collection, entity, nav):
+        target = nav_collections[nav]
+        if nav in entity:
+            return self._get(target, entity[nav]['@iot.id'])
+        reference = back_references[collection]
+        return [e for e in self.collections[target].values()
+                if (e.get(reference) or dict()).get('@iot.id') == entity['@iot.id']]
+
+    def _matches(self, entity, clauses):
+        for field, op, value in clauses:
+            if field == 'id':
+                actual = entity['@iot.id']
+            elif field.endswith('/id'):
+                actual = (entity.get(field[:-3]) or dict()).get('@iot.id')
+            elif field == 'phenomenonTime':
+                actual, value = parse_time(entity['phenomenonTime']), parse_time(value)
+            else:
+                actual = entity.get(field)
+            try:
+                if not compare[op](actual, value):
+                    return False
+            except TypeError:
+                return False
+        return True
+
+    def _filter(self, expression):
+        clauses, position = list(), 0
+        for m in filter_clause.finditer(expression):
+            if m.start() != position:
+                break
+            clauses.append((m.group(1), m.group(2), parse_literal(m.group(3))))
+            position = m.end()
+        if position != len(expression):
+            raise HTTPError(400, 'Unsupported $filter {!r}'.format(expression))
+        return clauses
+
+    # Render an entity with $select and $expand applied
+    def render(self, collection, entity, select=None, expand=None):
+        fields = select.split(',') if select else None
+        rendered = {k: v for k, v in entity.items() if k not in nav_collections and (fields is None or k in fields)}
+        if fields is None or '@iot.id' in fields or 'id' in fields:
+            rendered['@iot.id'] = entity['@iot.id']
+        for nav, options in parse_expand(expand).items():
+            related = self._related(collection, entity, nav)
+            target = nav_collections[nav]
+            if isinstance(related, list):
+                rendered[nav] = [self.render(target, e, options.get('$select'), options.get('$expand'))
+                                 for e in related]
+            else:
+                rendered[nav] = self.render(target, related, options.get('$select'), options.get('$expand'))
+        return rendered
+
+    def get(self, url):
+        parts = urlsplit(url)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        m = re.match(r'^/v1\.0/(\w+)(?:\((\d+)\))?(?:/(\w+))?$', parts.path)
+        if m is None or m.group(1) not in self.collections:
+            raise HTTPError(404, 'Unknown path {}'.format(parts.path))
+        collection, entity_id, nav = m.group(1), m.group(2), m.group(3)
+        if entity_id and not nav:
+            entity = self._get(collection, int(entity_id))
+            return self.render(collection, entity, query.get('$select'), query.get('$expand'))
+        if nav:
+            entities = self._related(collection, self._get(collection, int(entity_id)), nav)
+            collection = nav_collections[nav]
+        else:
+            entities = list(self.collections[collection].values())
+        if '$filter' in query:
+            clauses = self._filter(query['$filter'])
+            entities = [e for e in entities if self._matches(e, clauses)]
+        if query.get('$orderby', '').startswith('phenomenonTime'):
+            entities.sort(key=lambda e: parse_time(e['phenomenonTime']),
+                          reverse=query['$orderby'].endswith('desc'))
+        top = min(int(query.get('$top', self.max_page_size)), self.max_page_size)
+        skip = int(query.get('$skip', 0))
+        page = entities[skip:skip + top]
+        result = dict()
+        if query.get('$count') == 'true':
+            result['@iot.count'] = len(entities)
+        if skip + top < len(entities) and top > 0:
+            result['@iot.nextLink'] = '{}{}?{}'.format(self.url, parts.path,
+                                                       urlencode(dict(query, **{'$skip': skip + top})))
+        if query.get('$resultFormat') == 'dataArray':
+            components = query.get('$select', 'phenomenonTime,result').split(',')
+            result['value'] = [{'components': components, 'dataArray@iot.count': len(page),
+                                'dataArray': [[e.get(c) for c in components] for e in page]}] if page else []
+        else:
+            result['value'] = [self.render(collection, e, query.get('$select'), query.get('$expand')) for e in page]
+        return result
+
+    def post(self, path, body):
+        m = re.match(r'^/v1\.0/([\w$]+)(?:\((\d+)\)/(\w+))?$', path)
+        if m is None:
+            raise HTTPError(404, 'Unknown path {}'.format(path))
+        if m.group(1) == 'CreateObservations':
+            # like FROST, observations that can't be created are listed as 'error' instead of failing the request
+            created = list()
+            for group in body:
+                for row in group['dataArray']:
+                    observation = dict(zip(group['components'], row), Datastream=group['Datastream'])
+                    try:
+                        created.append('{}/v1.0/Observations({})'.format(
+                            self.url, self.create('Observations', observation)['@iot.id']))
+                    except HTTPError as e:
+                        created.append('error {}'.format(e))
+            return 201, created
+        if m.group(1) == '$batch':
+            return 200, {'responses': [self.batch_request(request) for request in body['requests']]}
+        if m.group(1) not in self.collections:
+            raise HTTPError(404, 'Unknown path {}'.format(path))
+        if m.group(3):
+            parent = self._get(m.group(1), int(m.group(2)))
+            return 201, self.render(nav_collections[m.group(3)], self.create(
+                nav_collections[m.group(3)], body, (back_references[m.group(1)], parent['@iot.id'])))
+        return 201, self.render(m.group(1), self.create(m.group(1), body))
+
+    def patch(self, path, body):
+        m = re.match(r'^/v1\.0/(\w+)\((\d+)\)$', path)
+        if m is None:
+            raise HTTPError(404, 'Unknown path {}'.format(path))
+        entity = self._get(m.group(1), int(m.group(2)))
+        with self.lock:
+            for field, value in body.items():
+                if field in nav_collections:
+                    value = {'@iot.id': self._get(nav_collections[field], value['@iot.id'])['@iot.id']}
+                entity[field] = value
+        return 200, self.render(m.group(1), entity)
+
+    def batch_request(self, request):
+        path = '/v1.0/' + request['url']
+        try:
+            if request['method'].lower() == 'post':
+                status, body = self.post(path, request.get('body'))
+            elif request['method'].lower() == 'patch':
+                status, body = self.patch(path, request.get('body'))
+            else:
+                status, body = 200, self.get(path)
+        except HTTPError as e:
+            status, body = e.status, {'message': str(e)}
+        return {'id': request.get('id'), 'status': status, 'body': body}
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                # headers and body are written separately, without this Nagle adds a delayed ACK per response
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self, method):
+                started = time.perf_counter()
+                if server.latency:
+                    time.sleep(server.latency)
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                    body = json.loads(self.rfile.read(length)) if length else None
+                    path = urlsplit(self.path).path
+                    if method == 'GET':
+                        status, result = 200, server.get(self.path)
+                    elif method == 'POST':
+                        status, result = server.post(path, body)
+                    else:
+                        status, result = server.patch(path, body)
+                except HTTPError as e:
+                    status, result = e.status, {'message': str(e)}
+                except (ValueError, KeyError, TypeError) as e:
+                    status, result = 400, {'message': repr(e)}
+                payload = json.dumps(result).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                server.requests.append((method, self.path, status, time.perf_counter() - started))
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def do_PATCH(self):
+                self._handle('PATCH')
+
+        return Handler
@@ -0,0 +1,174 @@
+import json
+import logging
+import multiprocessing
+import os
+
+import click
+import modelspec
+from session import build_session
+from sensorthings import SensorThingsClient
+
+here = os.path.dirname(os.path.abspath(__file__))
+# models every printer of the inventory is provisioned with unless it lists its own "specs"
+default_specs = [os.path.join(here, 'ultimaker.json'), os.path.join(here, 'cm_temperatures.json')]
+
+things_path = '/v1.0/Things'
+datastreams_path = '/v1.0/Datastreams'
+# collections shared by all printers, they are created once before the printers are provisioned
+shared_paths = ['/v1.0/Sensors', '/v1.0/ObservedProperties']
+
+
+# Load an inventory file (JSON or YAML), either a list of printers or {"printers": [...]}.
+# A printer needs a "name", "description", "properties" (e.g. its isprong_uuid) and "specs" (list of model files)
+# are optional.
+def load_inventory(filename):
+    inventory = modelspec.load_spec(filename)
+    printers = inventory.get('printers', []) if isinstance(inventory, dict) else inventory
+    names = set()
+    for printer in printers:
+        if 'name' not in printer:
+            raise ValueError('Printer without name in {}: {!r}'.format(filename, printer))
+        if printer['name'] in names:
+            raise ValueError('Duplicate printer {!r} in {}'.format(printer['name'], filename))
+        names.add(printer['name'])
+    return printers
+
+
+# Merge the model files of a printer into one spec for its thing. The first thing of the models is used
+# as template for the description of the printer, all datastreams are attached to the printer. Sensors and observed properties
+# are left out, they are provisioned once for all printers, see shared_spec.
+def printer_spec(printer, specs):
+    merged = {'units': dict(), 'Things': [], 'Datastreams': []}
+    for spec in specs:
+        merged['units'].update(spec.get('units', dict()))
+        merged['Things'].extend(spec.get('Things', []))
+        merged['Datastreams'].extend(spec.get('Datastreams', []))
+    thing = dict(merged['Things'][0]) if merged['Things'] else {'description': printer['name']}
+    thing['name'] = printer['name']
+    # the properties of the template describe one device (e.g. its isprong_uuid), they are only taken
+    # from the inventory
+    thing['properties'] = printer.get('properties', dict())
+    if 'description' in printer:
+        thing['description'] = printer['description']
+    merged['Things'] = [thing]
+    merged['Datastreams'] = [dict(ds, Thing=printer['name']) for ds in merged['Datastreams']]
+    return merged
+
+
+# Spec of the sensors and observed properties of all printers, the first definition of a name wins
+def shared_spec(specs):
+    shared = {'Sensors': [], 'ObservedProperties': []}
+    for spec in specs:
+        for key in shared:
+            for entity in spec.get(key, []):
+                if entity['name'] not in (e['name'] for e in shared[key]):
+                    shared[key].append(entity)
+    return shared
+
+
+# Split the server state into the part shared by all workers and the thing and datastreams of each printer,
+# so every task only carries the entities it can change
+def printer_state(state, name):
+    thing = state[things_path].get(name)
+    if thing is None:
+        return [], []
+    datastreams = [ds for key, ds in state[datastreams_path].items() if key[1] == str(thing['@iot.id'])]
+    return [thing], datastreams
+
+
+# the client of a worker process, see init_worker
+worker_client = None
+
+
+# Create the client of a worker process with its own connection pool and the shared catalog snapshot
+def init_worker(server, shared, pool_size):
+    global worker_client
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    worker_client = SensorThingsClient(server, session=build_session(pool_size=pool_size))
+    for path, entities in shared.items():
+        worker_client.model.set_collection(path, entities)
+
+
+# Provision the thing and datastreams of one printer, returns the printer name, the planned changes
+# and the name -> id map of the printer
+def provision_printer(task):
+    spec, things, datastreams, shared_changes, dry_run = task
+    client = worker_client
+    client.model.set_collection(things_path, things)
+    client.model.set_collection(datastreams_path, datastreams)
+    state = {path: client.model.model[path] for key, path in modelspec.spec_paths}
+    changes = modelspec.plan(client, spec, state, planned=shared_changes)
+    if not dry_run:
+        modelspec.apply(client, changes)
+    return spec['Things'][0]['name'], modelspec.format_plan(changes), printer_ids(client, spec)
+
+
+# Map the names of a printer's thing and datastreams to their ids, None for entities not created yet
+def printer_ids(client, spec):
+    thing = client.model.has_entity(things_path, spec['Things'][0]['name'])
+    thing_id = thing['@iot.id'] if thing else None
+    ids = {'@iot.id': thing_id, 'Datastreams': dict()}
+    for ds in spec['Datastreams']:
+        entity = client.model.has_entity(datastreams_path, ds['name'], {'Thing': {'@iot.id': thing_id}}) \
+            if thing_id is not None else None
+        ids['Datastreams'][ds['name']] = entity['@iot.id'] if entity else None
+    return ids
+
+
+@click.command()
+@click.argument('inventory')
+@click.option('--server', default='http://localhost:8082', help='URL of SensorThings server')
+@click.option('--workers', default=os.cpu_count() or 1, help='Number of worker processes')
+@click.option('--pool-size', default=4, help='Connections per worker process')
+@click.option('--output', default=None, help='Write the name to id map of each printer to this file')
+@click.option('--dry-run', is_flag=True, help='Only print the changes that would be made')
+def create_fleet(inventory, server, workers, pool_size, output, dry_run):
+    """Creates the models of all printers of an inventory file on SensorThings API server"""
+
+    # created and reused entities are logged by the clients
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    printers = load_inventory(inventory)
+    print('Creating SensorThings models of {} printers on {}'.format(len(printers), server))
+
+    # model files of a printer are relative to the inventory file
+    spec_files = dict()
+    for printer in printers:
+        printer['specs'] = [os.path.join(os.path.dirname(os.path.abspath(inventory)), filename)
+                            for filename in printer.get('specs', default_specs)]
+        for filename in printer['specs']:
+            if filename not in spec_files:
+                spec_files[filename] = modelspec.load_spec(filename)
+    specs = [printer_spec(printer, [spec_files[filename] for filename in printer['specs']]) for printer in printers]
+
+    # read the catalog once and create the sensors and observed properties shared by all printers,
+    # the workers start from this snapshot instead of reading the catalog themselves
+    st_client = SensorThingsClient(server)
+    state = modelspec.fetch_state(st_client)
+    changes = modelspec.plan(st_client, shared_spec(spec_files.values()), state)
+    print(modelspec.format_plan(changes))
+    if not dry_run:
+        modelspec.apply(st_client, changes)
+    shared = {path: list(state[path].values()) for path in shared_paths}
+    # in a dry run the shared entities are not created, the printers may still reference them
+    shared_changes = changes if dry_run else []
+    tasks = [(spec,) + tuple(printer_state(state, spec['Things'][0]['name'])) + (shared_changes, dry_run)
+             for spec in specs]
+
+    fleet = dict()
+    with multiprocessing.Pool(min(workers, len(tasks)) or 1, initializer=init_worker,
+                              initargs=(server, shared, pool_size)) as pool:
+        for name, plan, ids in pool.imap_unordered(provision_printer, tasks):
+            print('{}:\n{}'.format(name, plan))
+            fleet[name] = ids
+
+    fleet = {spec['Things'][0]['name']: fleet[spec['Things'][0]['name']] for spec in specs}
+    if output:
+        with open(output, 'w') as f:
+            json.dump(fleet, f, indent=2)
+        print('Wrote ids of {} printers to {}'.format(len(fleet), output))
+    else:
+        print(json.dumps(fleet, indent=2))
+
+
+if __name__ == '__main__':
+    create_fleet()
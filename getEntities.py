@@ -1,26 +1,240 @@
 import os
 import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
+from entities import from_json
+from instrumentation import Instrumentation
+from session import build_session
+
 
 #base_url = 'http://localhost:8082'
 entities = ["/v1.0/Things", "/v1.0/Locations", "/v1.0/HistoricalLocations", "/v1.0/Sensors",
             "/v1.0/Datastreams", "/v1.0/ObservedProperties", "/v1.0/Observations", "/v1.0/FeaturesOfInterest"]
 
+# only the fields needed for the duplicate check are downloaded
+select_fields = "@iot.id,name"
 
-class getModel:
-    def __init__(self, base_url):
+# number of entities requested per page, servers may cap this (FROST defaults to 100)
+default_page_size = 100
+
+
+# Quote a value as OData string literal for $filter expressions
+def odata_literal(value):
+    if isinstance(value, str):
+        return "'{}'".format(value.replace("'", "''"))
+    return json.dumps(value)
+
+
+# Ids given on the command line are strings, most servers use numeric ids
+def normalize_id(entity_id):
+    if isinstance(entity_id, str) and entity_id.isdigit():
+        return int(entity_id)
+    return entity_id
+
+
+# Path of a single entity, string ids are quoted as OData string literals
+def entity_path(path, entity_id):
+    return "{}({})".format(path, odata_literal(entity_id))
+
+
+# Some servers answer a create with an empty body and the URL of the new entity in the Location header
+def with_location_id(entity, location):
+    entity = entity or dict()
+    if "@iot.id" not in entity and location and location.endswith(")"):
+        entity_id = location[location.rindex("(") + 1:-1]
+        entity["@iot.id"] = json.loads(entity_id) if not entity_id.startswith("'") else entity_id[1:-1].replace("''", "'")
+    return entity
+
+
+def _get_page(session, url, params=None):
+    r = session.get(url, params=params)
+    r.raise_for_status()
+    return r.json()
+
+
+# Number of entities in a page, pages requested with $resultFormat=dataArray hold one entry per Datastream
+def page_length(values):
+    if values and "dataArray" in values[0]:
+        return sum(len(value["dataArray"]) for value in values)
+    return len(values)
+
+
+# Iterate over the pages of an entity collection, yields the list of entities of each page.
+# Follows @iot.nextLink and falls back to $top/$skip if the server does not send one.
+# With prefetch=True the next page is requested in the background while the current one is consumed.
+def iter_pages(base_url, path, params=None, page_size=default_page_size, prefetch=False, session=None):
+    session = session or requests
+    params = dict(params) if params else dict()
+    params.setdefault("$top", page_size)
+    skip = int(params.get("$skip", 0))
+    request = (base_url + path, params)
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    future = None
+    try:
+        page = _get_page(session, *request)
+        while True:
+            values = page.get("value", [])
+            if "@iot.nextLink" in page:
+                request = (page["@iot.nextLink"], None)
+            elif request[1] is not None and values and page_length(values) >= int(request[1]["$top"]):
+                skip += page_length(values)
+                request = (base_url + path, dict(params, **{"$skip": skip}))
+            else:
+                request = None
+            if executor and request:
+                future = executor.submit(_get_page, session, *request)
+            yield values
+            if request is None:
+                break
+            page = future.result() if future else _get_page(session, *request)
+            future = None
+    finally:
+        if future:
+            future.cancel()
+        if executor:
+            executor.shutdown(wait=False)
 
+
+# Iterate over all entities of a collection page by page, keeping at most two pages in memory
+def iter_entities(base_url, path, params=None, page_size=default_page_size, prefetch=False, session=None):
+    for values in iter_pages(base_url, path, params, page_size=page_size, prefetch=prefetch, session=session):
+        for entity in values:
+            yield entity
+
+
+# collections whose entities are identified by their name plus the ids of parent entities,
+# e.g. the same datastream name is used once per Thing
+default_composite_keys = {"/v1.0/Datastreams": ["Thing"]}
+
+
+class getModel:
+    def __init__(self, base_url, preload=None, composite_keys=None, session=None, cache=None,
+                 server_lookup=None, lookup_cache_size=1024, instrumentation=None):
+        self.base_url = base_url
+        self.session = session if session is not None else build_session()
+        # index hits and misses and all requests of the session are reported here
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        self.instrumentation.install(self.session)
+        # optional entitycache.EntityCache to skip fetching collections that did not change
+        self.cache = cache
+        self.composite_keys = default_composite_keys if composite_keys is None else composite_keys
+        # per collection index of key -> entity, collections are fetched on first use, see get_collection
         self.model = dict()
-        for ent in entities:
-            r = requests.get(base_url + ent)
-            self.model[ent] = r.json()["value"]
+        # collections that are never downloaded, has_entity asks the server with a $filter query instead
+        # (True for all collections), the answers are kept in a LRU cache of lookup_cache_size entries
+        self.server_lookup = server_lookup if server_lookup in (None, True) else set(server_lookup)
+        self.lookup_cache_size = lookup_cache_size
+        self.lookups = OrderedDict()
+        if preload:
+            self.preload(*preload)
+
+    # Fetch the given collections now instead of on first use
+    def preload(self, *paths):
+        for path in paths:
+            self._get_index(path)
+
+    # Return the cached entities of a path, fetching them from the server if necessary
+    def get_collection(self, path):
+        return list(self._get_index(path).values())
+
+    # Query parameters used to load a collection into the index
+    def collection_params(self, path):
+        params = {"$select": select_fields}
+        parents = self.composite_keys.get(path)
+        if parents:
+            params["$expand"] = ",".join("{}($select=@iot.id)".format(p) for p in parents)
+        return params
+
+    # Replace the cached entities of a path, e.g. with entities loaded by another client.
+    # Entities are kept as the compact classes of entities.py
+    def set_collection(self, path, entities):
+        index = dict()
+        for entity in entities:
+            entity = from_json(path, entity)
+            # keep the first entity like the server listing order did before
+            index.setdefault(self.entity_key(path, entity["name"], entity), entity)
+        self.model[path] = index
+
+    def _get_index(self, path):
+        if path not in self.model:
+            if self.cache is not None:
+                self.set_collection(path, self.cache.load(self, path))
+            else:
+                self.set_collection(path, iter_entities(self.base_url, path, self.collection_params(path),
+                                                        prefetch=True, session=self.session))
+        return self.model[path]
+
+    # Build the index key of an entity, data holds the parent references for composite keys
+    def entity_key(self, path, name, data=None):
+        parents = self.composite_keys.get(path)
+        if not parents:
+            return name
+        data = data or dict()
+        # ids are compared as strings, printer ids given on the command line are strings as well
+        ids = ((data.get(p) or dict()).get("@iot.id") for p in parents)
+        return (name,) + tuple(None if i is None else str(i) for i in ids)
 
     # Check if a entityname is already listed in a path
     # returns the entity if so and None if not
-    def has_entity(self, path, name):
-        for entity in self.model[path]:
-            if name == entity["name"]:
-                return entity
-        return None
+    def has_entity(self, path, name, data=None):
+        if self.is_server_lookup(path):
+            return self._lookup(path, name, data)
+        entity = self._get_index(path).get(self.entity_key(path, name, data))
+        self.instrumentation.count('entity_index_hits' if entity is not None else 'entity_index_misses')
+        return entity
+
+    # Write a newly created entity through into the index, data is the posted entity.
+    # Returns the indexed entity
+    def add_entity(self, path, entity, data=None):
+        name = entity.get("name", (data or dict()).get("name"))
+        key = self.entity_key(path, name, data if data is not None else entity)
+        if self.cache is not None:
+            self.cache.add(self, path, entity, data)
+        entity = from_json(path, dict(self._parent_refs(path, data), **dict(entity, name=name)))
+        if self.is_server_lookup(path):
+            self._remember(path, key, entity)
+        else:
+            self._get_index(path)[key] = entity
+        return entity
+
+    # References to the parents of the composite key of a posted entity, servers don't return them on create
+    def _parent_refs(self, path, data):
+        refs = dict()
+        for parent in self.composite_keys.get(path, []):
+            ref = (data or dict()).get(parent)
+            if isinstance(ref, dict) and "@iot.id" in ref:
+                refs[parent] = {"@iot.id": ref["@iot.id"]}
+        return refs
+
+    def is_server_lookup(self, path):
+        return self.server_lookup is True or (self.server_lookup is not None and path in self.server_lookup)
+
+    # Ask the server for an entity by name (and parents), answers including misses are memoized
+    def _lookup(self, path, name, data=None):
+        key = self.entity_key(path, name, data)
+        if (path, key) in self.lookups:
+            self.instrumentation.count('lookup_cache_hits')
+            self.lookups.move_to_end((path, key))
+            return self.lookups[(path, key)]
+        self.instrumentation.count('lookup_cache_misses')
+        conditions = ["name eq {}".format(odata_literal(name))]
+        for parent in self.composite_keys.get(path, []):
+            parent_id = normalize_id(((data or dict()).get(parent) or dict()).get("@iot.id"))
+            if parent_id is not None:
+                conditions.append("{}/id eq {}".format(parent, odata_literal(parent_id)))
+        r = self.session.get(self.base_url + path, params={"$filter": " and ".join(conditions),
+                                                           "$select": select_fields, "$top": 1})
+        r.raise_for_status()
+        values = r.json().get("value", [])
+        entity = from_json(path, values[0]) if values else None
+        self._remember(path, key, entity)
+        return entity
 
+    def _remember(self, path, key, entity):
+        self.lookups[(path, key)] = entity
+        self.lookups.move_to_end((path, key))
+        while len(self.lookups) > self.lookup_cache_size:
+            self.lookups.popitem(last=False)
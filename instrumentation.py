@@ -0,0 +1,191 @@
+import logging
+import re
+import threading
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+logger = logging.getLogger('sensorthings')
+
+# one HTTP request of the client, latency in seconds until the response headers were received
+RequestEvent = namedtuple('RequestEvent', 'method path status bytes_sent bytes_received latency retries')
+
+# entity ids in paths are replaced, so metrics are grouped per collection
+entity_id = re.compile(r'\([^)]*\)')
+
+
+def normalize_path(path):
+    return entity_id.sub('(id)', path)
+
+
+# Base class of instrumentation backends, override the events you are interested in
+class Backend:
+    def request(self, event):
+        pass
+
+    def count(self, name, value):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def entity(self, action, path, name):
+        pass
+
+
+# Log requests at DEBUG and created or reused entities at INFO to the 'sensorthings' logger
+class LoggingBackend(Backend):
+    def __init__(self, log=None):
+        self.log = log if log is not None else logger
+
+    def request(self, event):
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('%s %s %s %dB/%dB %.1fms retries=%d', event.method, event.path, event.status,
+                           event.bytes_sent, event.bytes_received, event.latency * 1000, event.retries)
+
+    def observe(self, name, value):
+        self.log.debug('%s %s', name, value)
+
+    def entity(self, action, path, name):
+        if action == 'existing':
+            self.log.info('already have %s', name)
+        else:
+            self.log.info('%s %s in path %s', 'Added' if action == 'created' else 'Updated', name, path)
+
+
+# Aggregate requests, counters and observed values in memory and render them in the OpenMetrics
+# text format, either with render() or served over HTTP with serve(port)
+class MetricsBackend(Backend):
+    latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, prefix='sensorthings_client'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.requests = dict()
+        self.counters = dict()
+        self.observed = dict()
+        self.httpd = None
+
+    def request(self, event):
+        key = (event.method, normalize_path(event.path), str(event.status))
+        with self.lock:
+            stats = self.requests.get(key)
+            if stats is None:
+                stats = self.requests[key] = {'count': 0, 'latency': 0.0, 'sent': 0, 'received': 0, 'retries': 0,
+                                              'buckets': [0] * len(self.latency_buckets)}
+            stats['count'] += 1
+            stats['latency'] += event.latency
+            stats['sent'] += event.bytes_sent
+            stats['received'] += event.bytes_received
+            stats['retries'] += event.retries
+            for i, bound in enumerate(self.latency_buckets):
+                if event.latency <= bound:
+                    stats['buckets'][i] += 1
+
+    def count(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self.lock:
+            count, total = self.observed.get(name, (0, 0))
+            self.observed[name] = (count + 1, total + value)
+
+    # counter families of the requests and the field of the request stats they count
+    request_counters = (('requests', 'count'), ('request_bytes_sent', 'sent'),
+                        ('request_bytes_received', 'received'), ('request_retries', 'retries'))
+
+    # Each family is rendered as one block after its TYPE line, OpenMetrics doesn't allow interleaving them
+    def render(self):
+        p = self.prefix
+        lines = list()
+        with self.lock:
+            requests = [('method="{}",path="{}",status="{}"'.format(*key), stats)
+                        for key, stats in sorted(self.requests.items())]
+            for name, field in self.request_counters[:1]:
+                lines.append('# TYPE {}_{} counter'.format(p, name))
+                lines.extend('{}_{}_total{{{}}} {}'.format(p, name, labels, stats[field]) for labels, stats in requests)
+            lines.append('# TYPE {}_request_latency_seconds histogram'.format(p))
+            for labels, stats in requests:
+                for bound, bucket in zip(self.latency_buckets, stats['buckets']):
+                    lines.append('{}_request_latency_seconds_bucket{{{},le="{}"}} {}'.format(p, labels, bound, bucket))
+                lines.append('{}_request_latency_seconds_bucket{{{},le="+Inf"}} {}'.format(p, labels, stats['count']))
+                lines.append('{}_request_latency_seconds_sum{{{}}} {}'.format(p, labels, stats['latency']))
+                lines.append('{}_request_latency_seconds_count{{{}}} {}'.format(p, labels, stats['count']))
+            for name, field in self.request_counters[1:]:
+                lines.append('# TYPE {}_{} counter'.format(p, name))
+                lines.extend('{}_{}_total{{{}}} {}'.format(p, name, labels, stats[field]) for labels, stats in requests)
+            for name, value in sorted(self.counters.items()):
+                lines.append('# TYPE {}_{} counter'.format(p, name))
+                lines.append('{}_{}_total {}'.format(p, name, value))
+            for name, (count, total) in sorted(self.observed.items()):
+                lines.append('# TYPE {}_{} summary'.format(p, name))
+                lines.append('{}_{}_count {}'.format(p, name, count))
+                lines.append('{}_{}_sum {}'.format(p, name, total))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    # Serve the metrics on http://<host>:<port>/metrics from a background thread
+    def serve(self, port, host=''):
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                payload = backend.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.httpd.serve_forever, name='metrics', daemon=True).start()
+        return self.httpd
+
+
+# Instrumentation of a client, dispatches request events, counters (e.g. entity index hits and misses),
+# observed values (e.g. batch sizes) and entity events to its backends. By default entity events are
+# logged, add a MetricsBackend or your own Backend for more.
+class Instrumentation:
+    def __init__(self, backends=None):
+        self.backends = list(backends) if backends is not None else [LoggingBackend()]
+
+    def add_backend(self, backend):
+        self.backends.append(backend)
+        return backend
+
+    # Report every request of a requests session
+    def install(self, session):
+        hooks = session.hooks.setdefault('response', [])
+        if self._on_response not in hooks:
+            hooks.append(self._on_response)
+
+    def _on_response(self, r, *args, **kwargs):
+        retries = getattr(getattr(r.raw, 'retries', None), 'history', None) or ()
+        body = r.request.body or b''
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        event = RequestEvent(r.request.method, urlsplit(r.url).path, r.status_code, len(body),
+                             len(r.content) if r.content else 0, r.elapsed.total_seconds(), len(retries))
+        self.request(event)
+
+    def request(self, event):
+        for backend in self.backends:
+            backend.request(event)
+
+    def count(self, name, value=1):
+        for backend in self.backends:
+            backend.count(name, value)
+
+    def observe(self, name, value):
+        for backend in self.backends:
+            backend.observe(name, value)
+
+    # action is 'created', 'updated' or 'existing'
+    def entity(self, action, path, name):
+        self.count('entities_' + action)
+        for backend in self.backends:
+            backend.entity(action, path, name)
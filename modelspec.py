@@ -0,0 +1,211 @@
+import json
+from collections import namedtuple
+
+from getEntities import entity_path, with_location_id
+from observations import unsupported_status
+from sensorthings import build_unit_of_measurement
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+# collections of a spec in the order they have to be created, datastreams reference the others
+spec_paths = [("Things", "/v1.0/Things"), ("Sensors", "/v1.0/Sensors"),
+              ("ObservedProperties", "/v1.0/ObservedProperties"), ("Datastreams", "/v1.0/Datastreams")]
+# references of a datastream to other entities of the spec
+datastream_refs = {"Thing": "/v1.0/Things", "Sensor": "/v1.0/Sensors", "ObservedProperty": "/v1.0/ObservedProperties"}
+
+# reference by name to an entity of the spec that does not exist on the server yet
+SpecRef = namedtuple("SpecRef", "path name")
+# a single write of a plan, action is "create" or "update"
+Change = namedtuple("Change", "action path name key data entity_id level")
+
+
+# Load a model spec from a JSON or YAML file
+def load_spec(filename):
+    with open(filename) as f:
+        if filename.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ImportError("Loading YAML specs requires PyYAML, run pip install pyyaml")
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+# Return the entities of a spec per path with units and references resolved, datastreams reference
+# other entities by name, units by their key in "units" or inline
+def normalize_spec(spec):
+    units = {key: build_unit_of_measurement(**unit) for key, unit in spec.get("units", dict()).items()}
+    normalized = dict()
+    for key, path in spec_paths:
+        entities = list()
+        names = set()
+        for entity in spec.get(key, []):
+            entity = dict(entity)
+            if key == "Datastreams":
+                unit = entity.get("unitOfMeasurement")
+                if isinstance(unit, str):
+                    if unit not in units:
+                        raise ValueError("Unknown unit {!r} in datastream {!r}".format(unit, entity["name"]))
+                    entity["unitOfMeasurement"] = units[unit]
+                entity_id = (entity.get("Thing"), entity["name"])
+            else:
+                entity_id = entity["name"]
+            if entity_id in names:
+                raise ValueError("Duplicate entity {!r} in {}".format(entity["name"], key))
+            names.add(entity_id)
+            entities.append(entity)
+        normalized[path] = entities
+    return normalized
+
+
+# Read the current state of all collections of a spec in one pass, returns path -> {key: entity}
+def fetch_state(client):
+    state = dict()
+    for key, path in spec_paths:
+        params = dict()
+        if path == "/v1.0/Datastreams":
+            params["$expand"] = ",".join("{}($select=@iot.id)".format(ref) for ref in datastream_refs)
+        entities = list(client.iter_entities(path, params, prefetch=True))
+        # the full entities are needed for the diff, keep them in the name index as well
+        client.model.set_collection(path, entities)
+        state[path] = client.model.model[path]
+    return state
+
+
+def _ref_id(ref):
+    return ref.get("@iot.id") if isinstance(ref, dict) else None
+
+
+# Compute the creates and PATCHes needed to bring the server to the state described by spec.
+# Datastreams may reference entities of the server, of the spec or created by the changes of an earlier plan
+# in planned, any other reference is an error.
+def plan(client, spec, state=None, planned=()):
+    entities = normalize_spec(spec)
+    state = state if state is not None else fetch_state(client)
+    defined = set((path, entity["name"]) for path, collection in entities.items() for entity in collection)
+    defined.update((change.path, change.name) for change in planned if change.action == "create")
+    changes = list()
+    for key, path in spec_paths:
+        level = 1 if path == "/v1.0/Datastreams" else 0
+        for desired in entities[path]:
+            data = dict(desired)
+            if level:
+                for ref, ref_path in datastream_refs.items():
+                    data[ref] = _resolve_ref(client, state, ref_path, data.get(ref))
+                    if isinstance(data[ref], SpecRef) and (ref_path, data[ref].name) not in defined:
+                        raise ValueError("Unknown {} {!r} in datastream {!r}, it is neither in the spec nor on "
+                                         "the server".format(ref, data[ref].name, data["name"]))
+            # entities referencing something that is still to be created are new as well
+            entity_key, current = None, None
+            if not any(isinstance(v, SpecRef) for v in data.values()):
+                entity_key = client.model.entity_key(path, data["name"], data)
+                current = state[path].get(entity_key)
+            if current is None:
+                changes.append(Change("create", path, data["name"], entity_key, data, None, level))
+                continue
+            diff = {field: value for field, value in data.items() if not _same(current, field, value)}
+            if diff:
+                changes.append(Change("update", path, data["name"], entity_key, diff, current["@iot.id"], level))
+    return changes
+
+
+def _resolve_ref(client, state, path, ref):
+    if ref is None or isinstance(ref, dict):
+        return ref
+    entity = state[path].get(client.model.entity_key(path, ref))
+    return {"@iot.id": entity["@iot.id"]} if entity else SpecRef(path, ref)
+
+
+def _same(current, field, value):
+    if field in datastream_refs:
+        return _ref_id(current.get(field)) == _ref_id(value)
+    return current.get(field) == value
+
+
+# Print a plan in a human readable form
+def format_plan(changes):
+    if not changes:
+        return "Nothing to do, server is up to date"
+    lines = list()
+    for change in changes:
+        if change.action == "create":
+            lines.append("create {} {!r}".format(change.path, change.name))
+        else:
+            lines.append("update {}({}) {!r}: {}".format(change.path, change.entity_id, change.name,
+                                                          ", ".join(sorted(change.data))))
+    return "\n".join(lines)
+
+
+# Execute a plan level by level, the writes of a level are sent as JSON $batch requests of at most
+# batch_size writes, or one request per write for servers without $batch support.
+# Returns a dict of (path, name) -> @iot.id of every created or updated entity.
+def apply(client, changes, batch_size=100):
+    ids = dict()
+    use_batch = True
+    for level in sorted(set(change.level for change in changes)):
+        todo = [_resolve_change(change, ids) for change in changes if change.level == level]
+        for start in range(0, len(todo), batch_size):
+            chunk = todo[start:start + batch_size]
+            results = _send_batch(client, chunk) if use_batch else None
+            if results is None:
+                use_batch = False
+                results = [_send(client, change) for change in chunk]
+            for change, entity in zip(chunk, results):
+                entity_id = entity.get("@iot.id", change.entity_id) if entity else change.entity_id
+                ids[(change.path, change.name)] = entity_id
+                if change.action == "create":
+                    entity = dict(entity or dict(), **{"@iot.id": entity_id})
+                    entity.setdefault("name", change.name)
+                    client.model.add_entity(change.path, entity, change.data)
+    return ids
+
+
+def _resolve_change(change, ids):
+    data = dict(change.data)
+    for field, value in change.data.items():
+        if isinstance(value, SpecRef):
+            data[field] = {"@iot.id": ids[(value.path, value.name)]}
+    return change._replace(data=data)
+
+
+def _url(change):
+    relative = change.path[len("/v1.0/"):]
+    if change.action == "update":
+        relative = entity_path(relative, change.entity_id)
+    return relative
+
+
+def _send(client, change):
+    method = "POST" if change.action == "create" else "PATCH"
+    r = client.session.request(method, client.base_url + "/v1.0/" + _url(change), data=json.dumps(change.data),
+                               headers={"Content-Type": "application/json"})
+    r.raise_for_status()
+    entity = r.json() if r.content else dict()
+    client.instrumentation.entity("created" if change.action == "create" else "updated", change.path, change.name)
+    return with_location_id(entity, r.headers.get("Location"))
+
+
+# Send the changes as one $batch request, returns the response bodies or None if $batch is not supported
+def _send_batch(client, changes):
+    client.instrumentation.observe("entity_batch_size", len(changes))
+    batch = [{"id": str(i), "method": "post" if change.action == "create" else "patch",
+              "url": _url(change), "body": change.data} for i, change in enumerate(changes)]
+    r = client.session.post(client.base_url + "/v1.0/$batch", data=json.dumps({"requests": batch}),
+                            headers={"Content-Type": "application/json"})
+    if r.status_code in unsupported_status:
+        return None
+    r.raise_for_status()
+    responses = {response.get("id"): response for response in r.json().get("responses", [])}
+    results = list()
+    for i, change in enumerate(changes):
+        response = responses.get(str(i), dict())
+        if response.get("status", 500) >= 400:
+            raise ValueError("Batch request for {} {!r} failed with status {}: {}".format(
+                change.path, change.name, response.get("status"), response.get("body")))
+        client.instrumentation.entity("created" if change.action == "create" else "updated", change.path,
+                                      change.name)
+        headers = {name.lower(): value for name, value in response.get("headers", dict()).items()}
+        results.append(with_location_id(response.get("body"), headers.get("location")))
+    return results
@@ -0,0 +1,203 @@
+import asyncio
+import json
+import queue
+import re
+import threading
+
+try:
+    import paho.mqtt.client as paho
+except ImportError:
+    paho = None
+
+from getEntities import entity_path
+from observations import build_observation
+
+topic_prefix = 'v1.0'
+observation_topic = re.compile(r'Datastreams\((.+)\)/Observations$')
+
+
+# MQTT topic of the Observations of a Datastream
+def observations_topic(datastream_id):
+    return entity_path(topic_prefix + '/Datastreams', datastream_id) + '/Observations'
+
+
+# Datastream id of an Observations topic, None for other topics
+def datastream_of_topic(topic):
+    m = observation_topic.search(topic)
+    if m is None:
+        return None
+    value = m.group(1)
+    return value[1:-1].replace("''", "'") if value.startswith("'") else json.loads(value)
+
+
+# Connection to a MQTT broker with paho-mqtt, subscriptions are renewed after reconnects
+class PahoTransport:
+    def __init__(self, host, port=1883, client_id='', username=None, password=None, keepalive=60):
+        if paho is None:
+            raise ImportError('MQTT support requires paho-mqtt, run pip install paho-mqtt')
+        if hasattr(paho, 'CallbackAPIVersion'):
+            self.client = paho.Client(paho.CallbackAPIVersion.VERSION2, client_id=client_id)
+        else:
+            self.client = paho.Client(client_id=client_id)
+        if username:
+            self.client.username_pw_set(username, password)
+        self.subscriptions = dict()
+        self.lock = threading.Lock()
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self.client.connect(host, port, keepalive)
+        self.client.loop_start()
+
+    def _on_connect(self, client, userdata, *args):
+        with self.lock:
+            topics = [(topic, qos) for topic, (callbacks, qos) in self.subscriptions.items()]
+        if topics:
+            client.subscribe(topics)
+
+    def _on_message(self, client, userdata, message):
+        with self.lock:
+            callbacks = list(self.subscriptions.get(message.topic, ([], 0))[0])
+        for callback in callbacks:
+            callback(message.topic, message.payload)
+
+    def publish(self, topic, payload, qos=0):
+        self.client.publish(topic, payload, qos=qos)
+
+    def subscribe(self, topic, callback, qos=0):
+        with self.lock:
+            self.subscriptions.setdefault(topic, ([], qos))[0].append(callback)
+        self.client.subscribe(topic, qos)
+
+    def unsubscribe(self, topic, callback):
+        with self.lock:
+            callbacks = self.subscriptions.get(topic, ([], 0))[0]
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if callbacks:
+                return
+            self.subscriptions.pop(topic, None)
+        self.client.unsubscribe(topic)
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+# In-process stand-in for a MQTT broker with the interface of PahoTransport, messages are delivered
+# synchronously to the subscribers of exactly the same topic. Useful for tests and benchmarks.
+class LocalBroker:
+    def __init__(self):
+        self.subscriptions = dict()
+        self.published = list()
+        self.lock = threading.Lock()
+
+    def publish(self, topic, payload, qos=0):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        with self.lock:
+            self.published.append((topic, payload))
+            callbacks = list(self.subscriptions.get(topic, []))
+        for callback in callbacks:
+            callback(topic, payload)
+
+    def subscribe(self, topic, callback, qos=0):
+        with self.lock:
+            self.subscriptions.setdefault(topic, []).append(callback)
+
+    def unsubscribe(self, topic, callback):
+        with self.lock:
+            callbacks = self.subscriptions.get(topic, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+
+    def close(self):
+        pass
+
+
+# Observations of a set of Datastreams received over MQTT, iterate over it to get
+# (datastream id, observation) tuples, with a for loop or with async for. With async for messages are
+# handed to the event loop of the first iteration, so a cancelled consumer leaves no thread blocked.
+class ObservationSubscription:
+    def __init__(self, transport, datastream_ids, queue_size=10000, timeout=None, qos=0):
+        self.transport = transport
+        self.timeout = timeout
+        self.queue = queue.Queue(queue_size)
+        self.queue_size = queue_size
+        self.loop = None
+        self.async_queue = None
+        self.dropped = 0
+        self.topics = [observations_topic(datastream_id) for datastream_id in datastream_ids]
+        for topic in self.topics:
+            transport.subscribe(topic, self._on_message, qos)
+
+    def _on_message(self, topic, payload):
+        message = (datastream_of_topic(topic), json.loads(payload))
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self._put_async, message)
+            except RuntimeError:
+                # the event loop is closed, nobody is waiting for messages anymore
+                self.dropped += 1
+            return
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            # a slow consumer must not block the network thread of the transport
+            self.dropped += 1
+
+    def _put_async(self, message):
+        try:
+            self.async_queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    # Hand messages to loop from now on, messages received before are moved over
+    def _bind(self, loop):
+        self.async_queue = asyncio.Queue(self.queue_size)
+        self.loop = loop
+        while True:
+            try:
+                self._put_async(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+    # Next (datastream id, observation), raises queue.Empty after timeout seconds without message
+    def get(self, timeout=None):
+        return self.queue.get(timeout=timeout if timeout is not None else self.timeout)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return self.get()
+        except queue.Empty:
+            raise StopIteration
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.loop is None:
+            self._bind(asyncio.get_running_loop())
+        try:
+            return await asyncio.wait_for(self.async_queue.get(), self.timeout)
+        except asyncio.TimeoutError:
+            raise StopAsyncIteration
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for topic in self.topics:
+            self.transport.unsubscribe(topic, self._on_message)
+
+
+# Publish a single Observation, the server creates it like a POST to the Datastream's Observations
+def publish_observation(transport, datastream_id, result, phenomenon_time=None, qos=0, **kwargs):
+    observation = build_observation(result, phenomenon_time, **kwargs)
+    transport.publish(observations_topic(datastream_id), json.dumps(observation), qos=qos)
+    return observation
@@ -0,0 +1,300 @@
+import atexit
+import json
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+import requests
+
+from getEntities import entity_path
+from instrumentation import Instrumentation
+
+log = logging.getLogger('sensorthings')
+
+
+# status codes of servers that do not implement the CreateObservations or $batch extension.
+# 404 is also the answer to a reading of a deleted datastream, so an extension answering 404 is only
+# switched off once the next way of sending accepted all readings.
+unsupported_status = (404, 405, 501)
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def build_observation(result, phenomenon_time=None, **kwargs):
+    observation = {'phenomenonTime': phenomenon_time if phenomenon_time else now_iso(), 'result': result}
+    observation.update(kwargs)
+    return observation
+
+
+# Buffers Observations per Datastream id and sends them in as few requests as possible.
+# Readings are flushed once batch_size readings are buffered or the oldest one waited max_delay seconds,
+# the latter by a background thread so readings of a datastream that went quiet are sent as well.
+# The CreateObservations dataArray extension is tried first, then a JSON $batch request and
+# finally one POST per Observation for servers that support neither.
+# Readings the server rejects (4xx, e.g. of a deleted datastream) are dropped and kept in rejected,
+# readings that failed for a transient reason (connection error, 5xx) are put back into the buffer.
+class ObservationBuffer:
+    def __init__(self, base_url, session, batch_size=500, max_delay=5.0, instrumentation=None, max_rejected=1000):
+        self.base_url = base_url
+        self.session = session
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.use_data_array = True
+        self.use_batch = True
+        self.buffer = dict()
+        self.count = 0
+        self.oldest = None
+        self.lock = threading.Lock()
+        # the newest max_rejected readings the server rejected as (datastream id, observation, reason)
+        self.rejected = deque(maxlen=max_rejected)
+        self.last_error = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __len__(self):
+        return self.count
+
+    def add(self, datastream_id, result, phenomenon_time=None, **kwargs):
+        self.add_many(datastream_id, [build_observation(result, phenomenon_time, **kwargs)])
+
+    # Buffer several Observations of a Datastream, each either a dict or a (phenomenonTime, result) tuple
+    def add_many(self, datastream_id, observations):
+        with self.lock:
+            readings = self.buffer.setdefault(datastream_id, [])
+            for observation in observations:
+                if not isinstance(observation, dict):
+                    observation = build_observation(observation[1], observation[0])
+                readings.append(observation)
+                self.count += 1
+            if self.oldest is None and self.count:
+                self.oldest = time.monotonic()
+        self.start()
+        if self.due():
+            self.flush()
+
+    # True if the size or time threshold is reached
+    def due(self):
+        if self.count >= self.batch_size:
+            return True
+        return self.oldest is not None and time.monotonic() - self.oldest >= self.max_delay
+
+    # Send all buffered Observations, returns the number of Observations the server accepted.
+    # On a transient failure the readings that were not sent are put back into the buffer and the error is raised.
+    def flush(self):
+        with self.lock:
+            buffer, self.buffer = self.buffer, dict()
+            count, self.count, self.oldest = self.count, 0, None
+        if not count:
+            return 0
+        rejected = list()
+        try:
+            self.send(buffer, rejected)
+        except Exception:
+            self.requeue(buffer)
+            raise
+        finally:
+            self.reject(rejected)
+        return count - len(rejected)
+
+    # Start the thread flushing readings that waited max_delay seconds, done on the first add.
+    # What is left is sent at exit.
+    def start(self):
+        if self.thread is None:
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run, name='observation-flusher', daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    # Stop the flusher thread and send what is left, called when the client is closed
+    def close(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+            atexit.unregister(self.close)
+        self.flush()
+
+    def _run(self):
+        while not self.stopped.wait(min(self.max_delay, 1.0)):
+            if self.oldest is not None and self.due():
+                try:
+                    self.flush()
+                except Exception as e:
+                    # the readings are back in the buffer and sent with the next flush
+                    self.last_error = repr(e)
+                    self.instrumentation.count('observation_send_failures')
+
+    def requeue(self, buffer):
+        with self.lock:
+            for datastream_id, readings in buffer.items():
+                if readings:
+                    self.buffer[datastream_id] = readings + self.buffer.get(datastream_id, [])
+                    self.count += len(readings)
+            if self.count:
+                self.oldest = time.monotonic()
+
+    # Drop readings the server rejected for good, they are logged, counted and kept in rejected
+    def reject(self, rejected):
+        self.rejected.extend(rejected)
+        report_rejected(self.instrumentation, rejected)
+
+    # Send the readings of buffer. Readings are removed from buffer once the server accepted or rejected them,
+    # so after a transient error (connection error, 5xx) buffer holds what still has to be sent.
+    # Readings rejected for good are appended to rejected as (datastream id, observation, reason).
+    def send(self, buffer, rejected=None):
+        rejected = rejected if rejected is not None else list()
+        self.instrumentation.observe('observation_batch_size', sum(len(readings) for readings in buffer.values()))
+        # extensions that answered 404, switched off if the fallback accepts every reading
+        missing = list()
+        settled = len(rejected)
+        if self.use_data_array:
+            r = self._post('/v1.0/CreateObservations', build_data_array(buffer))
+            if r.ok:
+                settle(buffer, data_array_order(buffer), data_array_statuses(r.json()), rejected)
+                return rejected
+            if self._unsupported(r, 'use_data_array'):
+                missing.append('use_data_array')
+        if self.use_batch:
+            r = self._post('/v1.0/$batch', build_batch(buffer))
+            if r.ok:
+                settle(buffer, batch_order(buffer), batch_statuses(r.json()), rejected)
+                self._switch_off(missing, len(rejected) == settled)
+                return rejected
+            if self._unsupported(r, 'use_batch'):
+                missing.append('use_batch')
+        for datastream_id in list(buffer):
+            readings = buffer[datastream_id]
+            while readings:
+                r = self._post(entity_path('/v1.0/Datastreams', datastream_id) + '/Observations', readings[0])
+                if r.status_code >= 500:
+                    r.raise_for_status()
+                if r.status_code >= 400:
+                    rejected.append((datastream_id, readings[0], error_reason(r.status_code, r.text)))
+                readings.pop(0)
+            del buffer[datastream_id]
+        self._switch_off(missing, len(rejected) == settled)
+        return rejected
+
+    # Check the answer of an extension endpoint that failed. Raises on errors that are worth a retry,
+    # returns True if the endpoint might not exist (404). 405 and 501 switch the extension off right away,
+    # on 400 the next way is used for this send only, it tells which readings are bad.
+    def _unsupported(self, r, attribute):
+        if r.status_code >= 500 and r.status_code != 501:
+            r.raise_for_status()
+        if r.status_code in (405, 501):
+            setattr(self, attribute, False)
+        elif r.status_code != 400 and r.status_code not in unsupported_status:
+            r.raise_for_status()
+        return r.status_code == 404
+
+    def _switch_off(self, missing, all_accepted):
+        if all_accepted:
+            for attribute in missing:
+                setattr(self, attribute, False)
+
+    def _post(self, path, data):
+        return self.session.post(self.base_url + path, data=json.dumps(data),
+                                 headers={"Content-Type": "application/json"})
+
+
+# Log and count readings the server rejected for good, given as (datastream id, observation, reason)
+def report_rejected(instrumentation, rejected):
+    if not rejected:
+        return
+    instrumentation.count('observations_rejected', len(rejected))
+    log.warning('%d observations were rejected by the server, first for datastream %s: %s',
+                len(rejected), rejected[0][0], rejected[0][2])
+
+
+# Readings of a buffer grouped per Datastream and set of components, as (datastream id, components, [index])
+# with the index of each reading in the readings of its datastream
+def data_array_groups(buffer):
+    for datastream_id, readings in buffer.items():
+        groups = dict()
+        for index, observation in enumerate(readings):
+            groups.setdefault(tuple(sorted(observation)), []).append(index)
+        for keys, indexes in groups.items():
+            components = ['phenomenonTime', 'result'] + [k for k in keys if k not in ('phenomenonTime', 'result')]
+            yield datastream_id, components, indexes
+
+
+# (datastream id, index) of each reading in the order of a CreateObservations request
+def data_array_order(buffer):
+    return [(datastream_id, index) for datastream_id, components, indexes in data_array_groups(buffer)
+            for index in indexes]
+
+
+# (datastream id, index) of each reading in the order of a $batch request
+def batch_order(buffer):
+    return [(datastream_id, index) for datastream_id, readings in buffer.items() for index in range(len(readings))]
+
+
+# (status, reason) of each reading of a CreateObservations response, which lists the URL of each
+# created Observation or an error
+def data_array_statuses(response):
+    return [(400, entry) if isinstance(entry, str) and entry.startswith('error') else (201, None)
+            for entry in response]
+
+
+# (status, reason) of each request of a $batch response
+def batch_statuses(response):
+    responses = {entry.get('id'): entry for entry in response.get('responses', [])}
+    statuses = list()
+    for i in range(len(responses)):
+        entry = responses.get(str(i), dict())
+        status = entry.get('status', 500)
+        statuses.append((status, error_reason(status, entry.get('body')) if status >= 400 else None))
+    return statuses
+
+
+def error_reason(status, body):
+    return '{} {}'.format(status, body if isinstance(body, str) else json.dumps(body))
+
+
+# Remove the readings the server accepted or rejected from buffer, rejected readings are appended to rejected.
+# Raises if some readings failed for a transient reason, they stay in buffer.
+def settle(buffer, order, statuses, rejected):
+    if len(statuses) != len(order):
+        raise requests.HTTPError('Server answered {} of {} observations'.format(len(statuses), len(order)))
+    pending = dict()
+    for (datastream_id, index), (status, reason) in zip(order, statuses):
+        if status >= 500:
+            pending.setdefault(datastream_id, set()).add(index)
+        elif status >= 400:
+            rejected.append((datastream_id, buffer[datastream_id][index], reason))
+    for datastream_id in list(buffer):
+        readings = [o for i, o in enumerate(buffer[datastream_id]) if i in pending.get(datastream_id, ())]
+        if readings:
+            buffer[datastream_id] = readings
+        else:
+            del buffer[datastream_id]
+    if pending:
+        raise requests.HTTPError('{} observations failed with a server error'.format(
+            sum(len(indexes) for indexes in pending.values())))
+
+
+# Build the body of a CreateObservations request, one dataArray per Datastream and set of components
+def build_data_array(buffer):
+    body = list()
+    for datastream_id, components, indexes in data_array_groups(buffer):
+        readings = buffer[datastream_id]
+        body.append({'Datastream': {'@iot.id': datastream_id},
+                     'components': components,
+                     'dataArray@iot.count': len(indexes),
+                     'dataArray': [[readings[i].get(c) for c in components] for i in indexes]})
+    return body
+
+
+# Build the body of a JSON $batch request with one POST per Observation
+def build_batch(buffer):
+    batch = list()
+    for datastream_id, readings in buffer.items():
+        url = entity_path('Datastreams', datastream_id) + '/Observations'
+        for observation in readings:
+            batch.append({'id': str(len(batch)), 'method': 'post', 'url': url, 'body': observation})
+    return {'requests': batch}
@@ -1,7 +1,21 @@
 import json
+from urllib.parse import urlsplit
 
-import requests
+from downsampling import DownsamplingBuffer
+from instrumentation import Instrumentation
 import getEntities
+import mqtt
+from observations import ObservationBuffer
+from session import build_session
+from spool import ObservationSpool
+
+
+# navigation properties that may hold nested entities for a deep insert and the collection they belong to
+nested_paths = {'Thing': '/v1.0/Things', 'Datastreams': '/v1.0/Datastreams', 'Sensor': '/v1.0/Sensors',
+                'ObservedProperty': '/v1.0/ObservedProperties'}
+# navigation property of a nested entity that points back to its parent
+parent_navigation = {'/v1.0/Things': 'Thing', '/v1.0/Sensors': 'Sensor',
+                     '/v1.0/ObservedProperties': 'ObservedProperty'}
 
 
 def build_unit_of_measurement(name, symbol, definition, **kwargs):
@@ -10,39 +24,151 @@ def build_unit_of_measurement(name, symbol, definition, **kwargs):
     return unit
 
 
+def build_thing(name, description, properties=None, datastreams=None, **kwargs):
+    thing = {'name': name,
+             'description': description,
+             'properties': properties if properties else dict()}
+    if datastreams:
+        thing['Datastreams'] = list(datastreams)
+    thing.update(kwargs)
+    return thing
+
+
+def build_datastream(name, description, observation_type, unit_of_measurement, observed_property, sensor,
+                     **kwargs):
+    data_stream = {'name': name,
+                   'description': description,
+                   'observationType': observation_type,
+                   'unitOfMeasurement': unit_of_measurement,
+                   'ObservedProperty': observed_property,
+                   'Sensor': sensor}
+    data_stream.update(kwargs)
+    return data_stream
+
+
+def build_observed_property(name, description, definition, **kwargs):
+    op = {'name': name, 'description': description, 'definition': definition}
+    op.update(kwargs)
+    return op
+
+
+def build_sensor(name, description, encoding_type, metadata, **kwargs):
+    sensor = {'name': name, 'description': description, 'encodingType': encoding_type,
+              'metadata': metadata}
+    sensor.update(kwargs)
+    return sensor
+
+
+# Yield (navigation property, path, nested entity) for all entities of data that are created by a deep insert
+def iter_nested(data):
+    for nav, path in nested_paths.items():
+        values = data.get(nav)
+        for value in values if isinstance(values, list) else [values]:
+            if isinstance(value, dict) and '@iot.id' not in value and 'name' in value:
+                yield nav, path, value
+
+
 class SensorThingsClient:
-    def __init__(self, base_url):
+    def __init__(self, base_url, preload=None, session=None, batch_size=500, max_delay=5.0, cache=None,
+                 server_lookup=None, spool=None, mqtt_transport=None, downsampling=None, instrumentation=None):
         self.base_url = base_url
-        self.model = getEntities.getModel(base_url)
+        # pooled keep-alive session shared with the model, pass your own to tune pool size and retries
+        self.session = session if session is not None else build_session()
+        # requests, index hits and misses, batch sizes and created entities are reported here,
+        # see instrumentation.Instrumentation
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        # entity collections are loaded lazily, pass e.g. preload=['/v1.0/Sensors'] to fetch some upfront
+        # and an entitycache.EntityCache to reuse the ids of earlier runs. With server_lookup=True entities
+        # are looked up one by one with $filter queries instead, for clients that can't hold the catalog.
+        self.model = getEntities.getModel(base_url, preload=preload, session=self.session, cache=cache,
+                                          server_lookup=server_lookup, instrumentation=self.instrumentation)
+        # observations are buffered per datastream and sent in batches, see observations.ObservationBuffer.
+        # With a spool file they are written to a local queue first and sent by a background thread,
+        # see spool.ObservationSpool
+        if spool:
+            self.observations = ObservationSpool(spool, base_url, self.session, batch_size=batch_size,
+                                                 flush_interval=max_delay, instrumentation=self.instrumentation)
+        else:
+            self.observations = ObservationBuffer(base_url, self.session, batch_size=batch_size,
+                                                  max_delay=max_delay, instrumentation=self.instrumentation)
+        # readings can be filtered and aggregated per datastream before they are buffered,
+        # see downsampling.DownsamplingBuffer for the configuration
+        if downsampling:
+            self.observations = DownsamplingBuffer(self.observations, downsampling, self.model)
+        # MQTT connection for subscribe_observations and publish_observation, by default a paho-mqtt
+        # connection to port 1883 of the server is opened on first use, see mqtt.py
+        self.mqtt_transport = mqtt_transport
+
+    # Stream all entities of a collection, see getEntities.iter_entities
+    def iter_entities(self, path, params=None, page_size=getEntities.default_page_size, prefetch=False):
+        return getEntities.iter_entities(self.base_url, path, params, page_size=page_size, prefetch=prefetch,
+                                         session=self.session)
 
-    def post_thing(self, name, description, properties=None, **kwargs):
-        thing = {'name': name,
-                 'description': description,
-                 'properties': properties if properties else dict()}
-        thing.update(kwargs)
-        return self._post(path='/v1.0/Things', data=thing)
+    # datastreams may be given as dicts (see build_datastream) to create them with the thing in one request
+    def post_thing(self, name, description, properties=None, datastreams=None, **kwargs):
+        return self._post(path='/v1.0/Things', data=build_thing(name, description, properties, datastreams, **kwargs))
 
+    # observed_property and sensor are either references like {'@iot.id': 1} or full entities
+    # (see build_observed_property and build_sensor) that are created together with the datastream
     def post_datastream(self, name, description, observation_type, unit_of_measurement, observed_property,
                         sensor, **kwargs):
-        data_stream = {'name': name,
-                       'description': description,
-                       'observationType': observation_type,
-                       'unitOfMeasurement': unit_of_measurement,
-                       'ObservedProperty': observed_property,
-                       'Sensor': sensor}
-        data_stream.update(kwargs)
-        return self._post(path='/v1.0/Datastreams', data=data_stream)
+        return self._post(path='/v1.0/Datastreams',
+                          data=build_datastream(name, description, observation_type, unit_of_measurement,
+                                                observed_property, sensor, **kwargs))
 
     def post_observed_property(self, name, description, definition, **kwargs):
-        op = {'name': name, 'description': description, 'definition': definition}
-        op.update(kwargs)
-        return self._post(path='/v1.0/ObservedProperties', data=op)
+        return self._post(path='/v1.0/ObservedProperties',
+                          data=build_observed_property(name, description, definition, **kwargs))
 
     def post_sensor(self, name, description, encoding_type, metadata, **kwargs):
-        sensor = {'name': name, 'description': description, 'encodingType': encoding_type,
-                  'metadata': metadata}
-        sensor.update(kwargs)
-        return self._post(path='/v1.0/Sensors', data=sensor)
+        return self._post(path='/v1.0/Sensors', data=build_sensor(name, description, encoding_type, metadata, **kwargs))
+
+    # Buffer a single reading of a datastream, it is sent with the next flush
+    def post_observation(self, datastream_id, result, phenomenon_time=None, **kwargs):
+        self.observations.add(datastream_id, result, phenomenon_time, **kwargs)
+
+    # Buffer several readings of a datastream, each a dict or a (phenomenon_time, result) tuple
+    def post_observations(self, datastream_id, observations):
+        self.observations.add_many(datastream_id, observations)
+
+    # Send all buffered observations now, returns the number of observations sent
+    def flush_observations(self):
+        return self.observations.flush()
+
+    # Read the observations of the datastreams between start and end into time aligned numpy arrays,
+    # a pandas DataFrame (output='pandas') or an Arrow table (output='arrow'), see export.get_observations
+    def get_observations(self, datastream_ids, start=None, end=None, output='numpy', **kwargs):
+        # imported here, numpy adds tens of MB to every process using the client
+        import export
+        return export.get_observations(self, datastream_ids, start, end, output=output, **kwargs)
+
+    def _mqtt(self):
+        if self.mqtt_transport is None:
+            self.mqtt_transport = mqtt.PahoTransport(urlsplit(self.base_url).hostname)
+        return self.mqtt_transport
+
+    # Subscribe to the observations of the given datastreams over MQTT, iterate over the returned
+    # subscription (for or async for) to receive (datastream id, observation) tuples.
+    # Iteration ends after timeout seconds without observation, None waits forever.
+    def subscribe_observations(self, datastream_ids, timeout=None, queue_size=10000, qos=0):
+        return mqtt.ObservationSubscription(self._mqtt(), datastream_ids, queue_size=queue_size, timeout=timeout,
+                                            qos=qos)
+
+    # Publish a single reading over MQTT instead of HTTP, the server creates the observation
+    def publish_observation(self, datastream_id, result, phenomenon_time=None, qos=0, **kwargs):
+        return mqtt.publish_observation(self._mqtt(), datastream_id, result, phenomenon_time, qos=qos, **kwargs)
+
+    # Send remaining observations, stop the background spool thread and close the MQTT connection
+    def close(self):
+        self.observations.close()
+        if self.mqtt_transport is not None:
+            self.mqtt_transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     # def _post(self, path, data, **kwargs):
     #     r = requests.post(self.base_url + path, data=json.dumps(data), **kwargs)
@@ -50,12 +176,92 @@ class SensorThingsClient:
     #     return r.json()
 
     def _post(self, path, data, **kwargs):
-        entity = self.model.has_entity(path, data["name"])
+        entity = self.model.has_entity(path, data["name"], data)
         if entity is None:
-            print("Added ", data["name"], " in path ", path)
-            r = requests.post(self.base_url + path, data=json.dumps(data), **kwargs)
+            data = self._link_nested(path, data, self._count_nested(path, data))
+            r = self.session.post(self.base_url + path, data=json.dumps(data),
+                                  headers={"Content-Type": "application/json"}, **kwargs)
             r.raise_for_status()
-            return r.json()
+            entity = getEntities.with_location_id(r.json() if r.content else None, r.headers.get("Location"))
+            self.instrumentation.entity('created', path, data["name"])
+            if any(iter_nested(data)):
+                entity = self._read_nested(path, entity, data)
+            return self.model.add_entity(path, entity, data)
         else:
-            print("already have ", data["name"])
+            self.instrumentation.entity('existing', path, data["name"])
+            # nested entities that belong to the existing entity, e.g. new datastreams of a thing, are added to it
+            for nav, child_path, child in iter_nested(data):
+                if self._is_bound(path, child_path):
+                    self._post(child_path, dict(child, **{parent_navigation[path]: {'@iot.id': entity['@iot.id']}}))
             return entity
+
+    # True if the entities of child_path are identified by the parent they are nested in,
+    # e.g. a datastream nested in a new thing is always new as well
+    def _is_bound(self, path, child_path):
+        return parent_navigation.get(path) in self.model.composite_keys.get(child_path, [])
+
+    # Count how often each nested entity occurs in a deep insert
+    def _count_nested(self, path, data, counts=None):
+        counts = counts if counts is not None else dict()
+        for nav, child_path, child in iter_nested(data):
+            if not self._is_bound(path, child_path):
+                key = (child_path, self.model.entity_key(child_path, child['name'], child))
+                counts[key] = counts.get(key, 0) + 1
+            self._count_nested(child_path, child, counts)
+        return counts
+
+    # Replace nested entities that already exist by references. Entities nested more than once,
+    # e.g. the sensor shared by all datastreams of a thing, are created first and referenced as well.
+    def _link_nested(self, path, data, counts):
+        linked = dict(data)
+        for nav in nested_paths:
+            values = data.get(nav)
+            if isinstance(values, list):
+                linked[nav] = [self._link_child(path, nested_paths[nav], value, counts) for value in values]
+            elif values is not None:
+                linked[nav] = self._link_child(path, nested_paths[nav], values, counts)
+        return linked
+
+    def _link_child(self, path, child_path, child, counts):
+        if not isinstance(child, dict) or '@iot.id' in child or 'name' not in child:
+            return child
+        if not self._is_bound(path, child_path):
+            existing = self.model.has_entity(child_path, child['name'], child)
+            key = (child_path, self.model.entity_key(child_path, child['name'], child))
+            if existing is None and counts.get(key, 0) > 1:
+                existing = self._post(child_path, child)
+            if existing is not None:
+                return {'@iot.id': existing['@iot.id']}
+        return self._link_nested(child_path, child, counts)
+
+    # Read the ids of all entities created by a deep insert back and add them to the name index
+    def _read_nested(self, path, entity, data):
+        r = self.session.get(self.base_url + getEntities.entity_path(path, entity['@iot.id']),
+                             params={'$select': getEntities.select_fields, '$expand': self._nested_expand(data)})
+        r.raise_for_status()
+        entity = dict(entity, **r.json())
+        self._index_nested(path, entity, data)
+        return entity
+
+    def _nested_expand(self, data):
+        expand = list()
+        for nav in nested_paths:
+            children = [child for child_nav, child_path, child in iter_nested(data) if child_nav == nav]
+            if children:
+                inner = ','.join(filter(None, (self._nested_expand(child) for child in children)))
+                expand.append('{}($select={}{})'.format(nav, getEntities.select_fields,
+                                                        ';$expand=' + inner if inner else ''))
+        return ','.join(sorted(set(expand)))
+
+    def _index_nested(self, path, entity, data):
+        for nav, child_path, child in iter_nested(data):
+            created = entity.get(nav)
+            created = {c.get('name'): c for c in (created if isinstance(created, list) else [created]) if c}
+            if child['name'] not in created:
+                continue
+            self.instrumentation.entity('created', child_path, child["name"])
+            key_data = dict(child)
+            if self._is_bound(path, child_path):
+                key_data[parent_navigation[path]] = {'@iot.id': entity['@iot.id']}
+            self.model.add_entity(child_path, created[child['name']], key_data)
+            self._index_nested(child_path, created[child['name']], child)
@@ -0,0 +1,20 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Build a requests session with a sized connection pool that keeps connections alive between calls.
+# Idempotent requests (GET, HEAD, PUT, DELETE, ...) are retried with exponential backoff,
+# POSTs are never retried to avoid creating entities twice.
+def build_session(pool_size=10, retries=3, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504)):
+    retry = Retry(total=retries, connect=retries, read=retries, status=retries,
+                  backoff_factor=backoff_factor, status_forcelist=status_forcelist,
+                  allowed_methods=Retry.DEFAULT_ALLOWED_METHODS, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Accept": "application/json",
+                            "Accept-Encoding": "gzip, deflate",
+                            "Connection": "keep-alive"})
+    return session
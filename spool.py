@@ -0,0 +1,177 @@
+import json
+import sqlite3
+import threading
+import time
+
+from observations import ObservationBuffer, build_observation
+
+
+# Durable write-ahead queue for Observations backed by SQLite.
+# add() only appends to the local database, a background thread sends the spooled Observations in
+# batches of batch_size (see ObservationBuffer.send) and deletes them once the server accepted them,
+# so delivery is at-least-once and survives restarts. Observations the server rejects for good (4xx) are
+# moved to the dead_letters table, transient failures (connection errors, 5xx) are retried with exponential
+# backoff between min_backoff and max_backoff seconds. It has the same interface as ObservationBuffer and is
+# used by SensorThingsClient when a spool file is given.
+class ObservationSpool:
+    def __init__(self, filename, base_url, session, batch_size=500, flush_interval=1.0, min_backoff=1.0,
+                 max_backoff=60.0, start=True, instrumentation=None):
+        self.sender = ObservationBuffer(base_url, session, batch_size=batch_size, instrumentation=instrumentation)
+        self.instrumentation = self.sender.instrumentation
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        # serializes sending, so the flusher thread and flush() never send the same rows
+        self.send_lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS observations (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "datastream TEXT NOT NULL, observation TEXT NOT NULL, queued REAL NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS dead_letters (id INTEGER PRIMARY KEY, datastream TEXT NOT NULL, "
+                        "observation TEXT NOT NULL, queued REAL NOT NULL, failed REAL NOT NULL, reason TEXT)")
+        self.db.commit()
+        # kept in memory so producers never have to count the table
+        self.pending = self.db.execute("SELECT COUNT(*) FROM observations").fetchone()[0]
+        self.dead = self.db.execute("SELECT COUNT(*) FROM dead_letters").fetchone()[0]
+        self.sent = 0
+        self.failures = 0
+        self.last_error = None
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+        self.thread = None
+        if start:
+            self.start()
+
+    def __len__(self):
+        return self.depth()
+
+    def add(self, datastream_id, result, phenomenon_time=None, **kwargs):
+        self.add_many(datastream_id, [build_observation(result, phenomenon_time, **kwargs)])
+
+    # Spool several Observations of a Datastream, each either a dict or a (phenomenonTime, result) tuple
+    def add_many(self, datastream_id, observations):
+        now = time.time()
+        rows = list()
+        for observation in observations:
+            if not isinstance(observation, dict):
+                observation = build_observation(observation[1], observation[0])
+            rows.append((json.dumps(datastream_id), json.dumps(observation), now))
+        with self.lock:
+            self.db.executemany("INSERT INTO observations (datastream, observation, queued) VALUES (?, ?, ?)", rows)
+            self.db.commit()
+            self.pending += len(rows)
+        if self.pending >= self.batch_size:
+            self.wakeup.set()
+
+    # Number of Observations waiting to be sent
+    def depth(self):
+        return self.pending
+
+    # Seconds the oldest waiting Observation is queued, 0 if the spool is empty
+    def lag(self):
+        with self.lock:
+            oldest = self.db.execute("SELECT MIN(queued) FROM observations").fetchone()[0]
+        return time.time() - oldest if oldest is not None else 0.0
+
+    def stats(self):
+        return {'depth': self.depth(), 'lag': self.lag(), 'sent': self.sent, 'failures': self.failures,
+                'dead_letters': self.dead, 'last_error': self.last_error}
+
+    # Observations the server rejected as (datastream id, observation, reason), oldest first
+    def dead_letters(self, limit=100):
+        with self.lock:
+            rows = self.db.execute("SELECT datastream, observation, reason FROM dead_letters ORDER BY id LIMIT ?",
+                                   (limit,)).fetchall()
+        return [(json.loads(datastream), json.loads(observation), reason) for datastream, observation, reason in rows]
+
+    # Send one batch of the oldest Observations, returns the number of Observations the server accepted or
+    # rejected. Accepted ones are deleted, rejected ones moved to dead_letters, the others stay in the spool.
+    def send_batch(self):
+        with self.send_lock:
+            with self.lock:
+                rows = self.db.execute("SELECT id, datastream, observation, queued FROM observations ORDER BY id "
+                                       "LIMIT ?", (self.batch_size,)).fetchall()
+            if not rows:
+                return 0
+            buffer = dict()
+            row_ids = dict()
+            for row_id, datastream, observation, queued in rows:
+                observation = json.loads(observation)
+                buffer.setdefault(json.loads(datastream), []).append(observation)
+                row_ids[id(observation)] = row_id
+            rejected = list()
+            try:
+                self.sender.send(buffer, rejected)
+            finally:
+                self._settle(rows, row_ids, buffer, rejected)
+            return len(rows)
+
+    # Delete the rows the server accepted and move the rejected ones to dead_letters, buffer holds the
+    # Observations that still have to be sent
+    def _settle(self, rows, row_ids, buffer, rejected):
+        unsent = set(row_ids[id(observation)] for readings in buffer.values() for observation in readings)
+        reasons = dict((row_ids[id(observation)], reason) for datastream_id, observation, reason in rejected)
+        now = time.time()
+        with self.lock:
+            self.db.executemany("INSERT INTO dead_letters (id, datastream, observation, queued, failed, reason) "
+                                "VALUES (?, ?, ?, ?, ?, ?)",
+                                [row + (now, reasons[row[0]]) for row in rows if row[0] in reasons])
+            done = [(row[0],) for row in rows if row[0] not in unsent]
+            self.db.executemany("DELETE FROM observations WHERE id = ?", done)
+            self.db.commit()
+            self.pending -= len(done)
+        self.sent += len(done) - len(reasons)
+        self.dead += len(reasons)
+        if reasons:
+            self.instrumentation.count('observations_rejected', len(reasons))
+
+    # Send everything that is spooled now, returns the number of Observations the server accepted.
+    # Errors are raised, the Observations that were not sent stay in the spool.
+    def flush(self):
+        sent = self.sent
+        while self.send_batch():
+            pass
+        return self.sent - sent
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run, name='observation-spool', daemon=True)
+            self.thread.start()
+
+    # Stop the flusher thread, by default after trying to send what is spooled
+    def close(self, flush=True):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if flush:
+            try:
+                self.flush()
+            except Exception as e:
+                # the Observations stay in the spool and are sent by the next run
+                self.last_error = repr(e)
+        with self.lock:
+            self.db.close()
+
+    def _run(self):
+        backoff = self.min_backoff
+        while not self.stopped.is_set():
+            try:
+                sent = self.send_batch()
+                backoff = self.min_backoff
+            except Exception as e:
+                self.failures += 1
+                self.last_error = repr(e)
+                self.instrumentation.count('spool_send_failures')
+                self.stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            # keep draining full batches, otherwise wait for new Observations
+            if sent < self.batch_size:
+                self.wakeup.wait(self.flush_interval)
+                self.wakeup.clear()
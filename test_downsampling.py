@@ -0,0 +1,71 @@
+import time
+import unittest
+
+from downsampling import Deadband, DownsamplingBuffer, RateLimit, WindowAggregate
+from fakeserver import FakeSensorThingsServer
+from getEntities import getModel
+from observations import ObservationBuffer
+from session import build_session
+
+
+class DownsamplingBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSensorThingsServer().start()
+        self.server.seed('Datastreams', [{'name': 'Temp321'}, {'name': 'Temp322'}, {'name': 'Temp323'}])
+        self.inner = ObservationBuffer(self.server.url, build_session(retries=0), batch_size=100, max_delay=60)
+        self.buffer = DownsamplingBuffer(self.inner, {1: [Deadband()], 2: [WindowAggregate(60)], 3: [RateLimit(60)]})
+
+    def tearDown(self):
+        self.buffer.close()
+        self.server.stop()
+
+    def observations(self):
+        return list(self.server.collections['Observations'].values())
+
+    def test_tuples_without_time(self):
+        for datastream_id in (1, 2, 3):
+            self.buffer.add_many(datastream_id, [(None, 1.0), (None, 1.0)])
+        self.buffer.flush()
+        observations = self.observations()
+        self.assertEqual(len(observations), 3)
+        for observation in observations:
+            self.assertIsNotNone(observation.get('phenomenonTime'))
+
+    def test_deadband_suppresses_unchanged(self):
+        self.buffer.add_many(1, [('2024-01-01T00:00:0{}Z'.format(i), value) for i, value in enumerate([1, 1, 1, 2])])
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(sorted(o['parameters']['suppressed'] for o in self.observations()), [0, 2])
+
+    def test_stages_configured_by_name(self):
+        model = getModel(self.server.url, session=build_session(retries=0))
+        buffer = DownsamplingBuffer(self.inner, {'Temp322': [Deadband()]}, model)
+        self.addCleanup(buffer.close)
+        self.server.reset_stats()
+        for datastream_id in (2, 2, 3, 999):
+            buffer.add(datastream_id, 1.0)
+        self.assertEqual(len(self.inner), 3)
+        # only the two datastreams are looked up, the collection is not downloaded
+        self.assertEqual([request[1] for request in self.server.requests],
+                         ['/v1.0/Datastreams(2)?%24select=name', '/v1.0/Datastreams(3)?%24select=name',
+                          '/v1.0/Datastreams(999)?%24select=name'])
+
+    def test_window_keeps_upstream_parameters(self):
+        buffer = DownsamplingBuffer(self.inner, {1: [Deadband(), WindowAggregate(60)]})
+        self.addCleanup(buffer.close)
+        buffer.add_many(1, [('2024-01-01T00:00:0{}Z'.format(i), value) for i, value in enumerate([1, 1, 2, 2, 3])])
+        self.assertEqual(buffer.flush(), 1)
+        parameters = self.observations()[0]['parameters']
+        self.assertEqual((parameters['count'], parameters['suppressed'], parameters['deadband']), (3, 2, 0))
+
+    def test_quiet_window_is_sent(self):
+        self.inner.max_delay = 0.2
+        buffer = DownsamplingBuffer(self.inner, {1: [WindowAggregate(1)]}, interval=0.1)
+        self.addCleanup(buffer.close)
+        buffer.add(1, 20.5)
+        time.sleep(2.5)
+        self.assertEqual(len(self.observations()), 1)
+        self.assertEqual(self.observations()[0]['result'], 20.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import time
+import unittest
+
+from fakeserver import FakeSensorThingsServer
+from observations import ObservationBuffer
+from session import build_session
+
+
+class ObservationBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSensorThingsServer().start()
+        self.server.seed('Datastreams', [{'name': 'Temp321'}])
+        self.buffer = ObservationBuffer(self.server.url, build_session(retries=0), batch_size=100, max_delay=60)
+
+    def tearDown(self):
+        self.buffer.close()
+        self.server.stop()
+
+    def observations(self):
+        return len(self.server.collections['Observations'])
+
+    def test_rejected_reading_is_dropped(self):
+        for flush in range(2):
+            self.buffer.add(999, 1)
+            self.buffer.add_many(1, [(None, i) for i in range(3)])
+            self.assertEqual(self.buffer.flush(), 3)
+        self.assertEqual(self.observations(), 6)
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual([r[0] for r in self.buffer.rejected], [999, 999])
+        # a bad reading must not switch the extensions off
+        self.assertTrue(self.buffer.use_data_array)
+        self.assertTrue(self.buffer.use_batch)
+
+    def test_server_error_keeps_readings(self):
+        post = self.server.post
+        self.server.post = lambda path, body: (503, {'message': 'unavailable'})
+        self.buffer.add(1, 20.5)
+        with self.assertRaises(Exception):
+            self.buffer.flush()
+        self.assertEqual(len(self.buffer), 1)
+        self.server.post = post
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(self.observations(), 1)
+
+    def test_missing_extensions_are_switched_off(self):
+        post = self.server.post
+
+        def without_extensions(path, body):
+            if path in ('/v1.0/CreateObservations', '/v1.0/$batch'):
+                return 404, {'message': 'Unknown path {}'.format(path)}
+            return post(path, body)
+        self.server.post = without_extensions
+        self.buffer.add(1, 20.5)
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertFalse(self.buffer.use_data_array)
+        self.assertFalse(self.buffer.use_batch)
+        self.assertEqual(self.observations(), 1)
+
+    def test_quiet_datastream_is_flushed(self):
+        self.buffer.max_delay = 0.2
+        self.buffer.add(1, 20.5)
+        time.sleep(1.5)
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(self.observations(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
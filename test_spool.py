@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from fakeserver import FakeSensorThingsServer
+from session import build_session
+from spool import ObservationSpool
+
+
+class ObservationSpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = FakeSensorThingsServer().start()
+        self.server.seed('Datastreams', [{'name': 'Temp321'}])
+        self.spool = ObservationSpool(os.path.join(self.directory, 'spool.db'), self.server.url,
+                                      build_session(retries=0), start=False)
+
+    def tearDown(self):
+        self.spool.close()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def test_rejected_reading_is_dead_lettered(self):
+        self.spool.add(999, 1)
+        self.spool.add_many(1, [(None, i) for i in range(3)])
+        self.assertEqual(self.spool.flush(), 3)
+        self.spool.add(1, 4)
+        self.assertEqual(self.spool.flush(), 1)
+        stats = self.spool.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['dead_letters'], 1)
+        self.assertEqual(len(self.server.collections['Observations']), 4)
+        self.assertEqual([entry[0] for entry in self.spool.dead_letters()], [999])
+
+    def test_server_error_keeps_readings(self):
+        post = self.server.post
+        self.server.post = lambda path, body: (503, {'message': 'unavailable'})
+        self.spool.add(1, 20.5)
+        with self.assertRaises(Exception):
+            self.spool.flush()
+        self.assertEqual(self.spool.depth(), 1)
+        self.server.post = post
+        self.assertEqual(self.spool.flush(), 1)
+        self.assertEqual(self.spool.stats()['dead_letters'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()